@@ -0,0 +1,65 @@
+"""
+Times unions of random occurrence-like circles at 1k, 10k, and 100k circles:
+
+sequential -- adds circles to a growing union one at a time, like
+              aggregating with GUnion (only run up to 'sequential_max').
+union_all -- one GEOS unary union of every circle.
+cascaded -- repo_functions.cascaded_union with 1 and 'workers' processes.
+coarsened -- cascaded_union keeping 'coarsen' vertices per circle.
+
+Circles are 64-vertex polygons with 1-10 km radii scattered over an area
+about the size of North Carolina (Albers meters), so density rises with the
+count the way it does for common species.
+"""
+import time
+import numpy as np
+import shapely
+import repo_functions as functions
+
+counts = (1000, 10000, 100000)
+workers = 4
+partition_size = 2000
+coarsen = 16
+sequential_max = 1000
+
+def circles(count, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = shapely.points(rng.uniform(0, 800000, count),
+                             rng.uniform(0, 300000, count))
+    return list(shapely.to_wkb(shapely.buffer(centers,
+                                              rng.uniform(1000, 10000, count),
+                                              quad_segs=16)))
+
+def timed(func, *args, **kwargs):
+    start = time.time()
+    result = func(*args, **kwargs)
+    return time.time() - start, result
+
+def sequential(wkbs):
+    union = shapely.from_wkb(wkbs[0])
+    for wkb in wkbs[1:]:
+        union = union.union(shapely.from_wkb(wkb))
+    return shapely.to_wkb(union)
+
+def union_all(wkbs):
+    return shapely.to_wkb(shapely.union_all(shapely.from_wkb(wkbs)))
+
+if __name__ == '__main__':
+    print("{0:>8} {1:>12} {2:>10} {3:>12}".format('circles', 'method',
+                                                 'seconds', 'area km2'))
+    for count in counts:
+        wkbs = circles(count)
+        runs = [('union_all', union_all, {}),
+                ('cascaded', functions.cascaded_union,
+                 {'partition_size': partition_size}),
+                ('cascaded x{0}'.format(workers), functions.cascaded_union,
+                 {'workers': workers, 'partition_size': partition_size}),
+                ('coarsened x{0}'.format(workers), functions.cascaded_union,
+                 {'workers': workers, 'partition_size': partition_size,
+                  'coarsen': coarsen})]
+        if count <= sequential_max:
+            runs.insert(0, ('sequential', sequential, {}))
+        for name, func, kwargs in runs:
+            seconds, union = timed(func, wkbs, **kwargs)
+            print("{0:>8} {1:>12} {2:>10.2f} {3:>12.1f}".format(
+                  count, name, seconds, shapely.from_wkb(union).area / 1e6))
@@ -13,3 +13,24 @@ outDir = workDir + 'Outputs/'
 default_coordUncertainty = 100
 SRID_dict = {'WGS84': 4326, 'AlbersNAD83': 102008} # Used in file names for output.
 spdb = outDir + sp_id + gbif_req_id + gbif_filter_id + '.sqlite'
+gbif_page_size = 300 # Records per GBIF search request; 300 is the maximum.
+gbif_workers = None # GBIF request threads; None for the request governor's maximum concurrency, which decides how many run at once.
+gbif_cache = inDir + 'gbif_cache.sqlite' # On-disk cache of GBIF responses.
+gbif_cache_max_mb = 2000 # Size cap for the GBIF cache.
+gbif_cache_ttl_days = 30 # Re-download cached GBIF responses older than this.
+gbif_cache_refresh = False # True to ignore (and replace) cached responses.
+gbif_download_threshold = 50000 # Use a GBIF download above this many records.
+gbif_partition_size = 10000 # Split larger GBIF requests into partitions.
+buffer_segments = 64 # Number of vertices in occurrence circles.
+buffer_chunk_size = 50000 # Occurrences buffered per chunk.
+buffer_workers = 1 # Processes for buffering; more than 1 buffers chunks in parallel.
+eval_workers = 4 # Processes for intersecting occurrence circles with hucs.
+shucLoc = '/users/nmtarr/data/SHUCS' # SHUCS shapefile, without extension.
+huc_db = inDir + 'huc12_reference.sqlite' # Shared, read-only huc database.
+huc_store = inDir + 'huc12_store/' # Memory-mapped, packed huc polygons.
+gap_workers = 4 # GAP range downloads to run at once when prefetching.
+gap_range_cache = inDir + 'gap_range_cache.sqlite' # Reprojected GAP ranges.
+hull_workers = 4 # Range polygon periods to build at once.
+union_workers = 4 # Processes for unioning occurrence circles.
+union_partition_size = 2000 # Circles unioned together before merging.
+union_coarsen = None # Vertices kept per circle when unioning for range polygons; None keeps all.
@@ -13,5 +13,8 @@ For now, a single species has been manually entered into species-concepts
 for development.
 """
 from pygbif import species
-key = species.name_backbone(name = 'Ammodramus maritimus macgillivraii', rank='species')['usageKey']
+import repo_functions as functions
+key = functions.request_governor.call('api.gbif.org', species.name_backbone,
+                                      name = 'Ammodramus maritimus macgillivraii',
+                                      rank='species')['usageKey']
 print(key)
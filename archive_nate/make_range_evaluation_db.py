@@ -1,12 +1,18 @@
 """
 Builds an sqlite database in which to store range evaluation information.
+HUCs aren't copied in; they come from a shared reference database (built from
+the SHUCS shapefile when it is missing or the shapefile has changed) that is
+attached when evaluating.  The GAP range polygons are added as gap_range, in
+WGS84, from the shared cache of reprojected ranges; eval_gbif1.py maps the
+evaluation with them.
 
-shucloc needs to be eventually be replaced wtih ScienceBase download of shucs.
+shucLoc needs to be eventually be replaced wtih ScienceBase download of shucs.
 """
 import config
 import sqlite3
 import pandas as pd
 import os
+import repo_functions as functions
 
 # Get gap id
 conn2 = sqlite3.connect(config.inDir + 'parameters.sqlite')
@@ -30,7 +36,11 @@ conn.enable_load_extension(True)
 conn.execute('SELECT load_extension("mod_spatialite")')
 cursor = conn.cursor()
 
-shucLoc = '/users/nmtarr/data/SHUCS'
+# Build the shared huc reference database if needed
+if functions.build_huc_reference_db(config.shucLoc, config.huc_db):
+    print("Built huc reference database {0}".format(config.huc_db))
+if functions.build_huc_store(config.huc_db, config.huc_store):
+    print("Built huc store {0}".format(config.huc_store))
 
 sql="""
 SELECT InitSpatialMetadata();
@@ -55,16 +65,15 @@ SELECT InitSpatialMetaData();
              PARAMETER["latitude_of_center",40],
              UNIT["Meter",1],AUTHORITY["EPSG","102008"]]');
 
-
-/* Add the hucs shapefile to the db. */
-SELECT ImportSHP('{0}', 'shucs', 'utf-8', 102008,
-                 'geom_102008', 'HUC12RNG', 'POLYGON');
-""".format(shucLoc)
+"""
 cursor.executescript(sql)
 
 # Load the GAP range csv, filter out some columns, rename others
 csvfile = config.inDir + gap_id + "_CONUS_RANGE_2001v1.csv"
-sp_range = pd.read_csv(csvfile)
+# HUC ids are zero-padded 12 digit strings; read as numbers they would lose
+# the leading zero and not match the hucs in the huc reference database.
+sp_range = pd.read_csv(csvfile, dtype={'strHUC12RNG': str})
+sp_range['strHUC12RNG'] = sp_range['strHUC12RNG'].str.zfill(12)
 sp_range.to_sql('sp_range', conn, if_exists='replace', index=False)
 
 sql2="""
@@ -84,3 +93,29 @@ CREATE TABLE sp_range AS
 DROP TABLE garb;
 """
 cursor.executescript(sql2)
+
+# Add the GAP range polygons in WGS84, from the shared cache of reprojected
+# ranges (the range is only imported and transformed when it has changed, and
+# retrieve_occurrences.py caches the same WGS84 version for its maps).
+try:
+    gap_range = functions.download_GAP_range_CONUS2001v1(gap_id, config.inDir)
+    range_rows = functions.reprojected_GAP_range(gap_id, gap_range,
+                                                 config.gap_range_cache, 4326)
+except Exception as e:
+    print("No GAP range polygons were added: {0}".format(e))
+    range_rows = []
+cursor.executescript("""
+    CREATE TABLE gap_range (HUC12RNG TEXT, seasonCode INTEGER,
+                            seasonName TEXT);
+
+    SELECT AddGeometryColumn('gap_range', 'geom_4326', 4326,
+                             'MULTIPOLYGON', 'XY');
+
+    CREATE INDEX gap_range_huc ON gap_range (HUC12RNG);
+    """)
+cursor.executemany("""INSERT INTO gap_range
+                      VALUES (?, ?, ?,
+                              CastToMultiPolygon(GeomFromWKB(?, 4326)));""",
+                   [(str(huc).zfill(12), code, name, wkb)
+                    for huc, code, name, wkb in range_rows])
+conn.commit()
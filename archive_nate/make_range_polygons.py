@@ -39,162 +39,234 @@ import os
 os.chdir('/')
 os.chdir(codeDir)
 import config
+import repo_functions as functions
 import sqlite3
 import os
 
 
-#############################################################################
-#                              Species-concept
-#############################################################################
-os.chdir(codeDir)
-# Get species info from requests database
-conn2 = sqlite3.connect(inDir + 'requests.sqlite')
-cursor2 = conn2.cursor()
-sql_tax = """SELECT gbif_id, common_name, scientific_name,
-                    error_tolerance, gap_id, min_count, migratory
-             FROM species_concepts
-             WHERE species_id = '{0}';""".format(sp_id)
-concept = cursor2.execute(sql_tax).fetchall()[0]
-gbif_id = concept[0]
-common_name = concept[1]
-scientific_name = concept[2]
-error_toler = concept[3]
-gap_id = concept[4]
-min_count = concept[5]
-migratory = concept[6]
-
-
-#############################################################################
-#                          Connect to Database
-#############################################################################
-# Delete the database if it already exists
-if os.path.exists(config.eval_db):
-    os.remove(config.eval_db)
-
-# Create or connect to the database
-conn = sqlite3.connect(config.eval_db)
-os.putenv('SPATIALITE_SECURITY', 'relaxed')
-conn.enable_load_extension(True)
-conn.execute('SELECT load_extension("mod_spatialite")')
-cursor = conn.cursor()
-
-# Make db spatial
-cursor.execute('SELECT InitSpatialMetadata();')
-
-sql_rngy = """
-        /* Make a table for storing range maps for unique species-time period
-           combinations, needs GEOMETRY */
-        CREATE TABLE IF NOT EXISTS range_polygons (
-                     rng_polygon_id TEXT NOT NULL PRIMARY KEY,
-                     alias TEXT UNIQUE,
-                     species_id TEXT NOT NULL,
-                     months TEXT,
-                     years TEXT,
-                     method TEXT,
-                     max_uncertainty_meters INTEGER,
-                     min_count INTEGER,
-                     date_created TEXT
-                     );
-            """
-cursor.executescript(sql_rngy)
-
-sql_geom = """SELECT AddGeometryColumn('range_polygons', 'range_4326', 4326,
-                         'MULTIPOLYGON', 'XY');
-
-              SELECT AddGeometryColumn('range_polygons', 'occurrences_4326', 4326,
-                         'MULTIPOLYGON', 'XY');"""
-cursor.executescript(sql_geom)
-
-
-#############################################################################
-#                          Make Some Range Polygons
-#############################################################################
-# Function for making range_polygons
-def MakeConcaveHull(rng_poly_id, alias, sp_id, months, years,
-                    max_uncertainty, outDir, export, factor=2,
-                    allow_holes=True):
-    """
-    Function for creating a range polygon entry in range_eval.range_polygons.
-
-    Arguments:
-    rng_poly_id -- A unique ID to use for the range map record
-    alias -- keyword to use for filenames and shorthand reference to polygon
-    sp_id -- species id for this project.  Must be in requests.species_concepts.
-    months -- tuple of months to include.  For example: (3,4,5,6,7)
-    years -- tuple of start and end years to use.  Format as (1980,2000)
-    max_uncertainty -- max coordinate uncertainty to allow when filtering
-                            occurrences for use in polygon delineation.
-    factor -- factor to use in concave hull; defaults to 2.
-    allow_holes -- True or False for holes within the range.
-    outDir -- working directory, where to put the output.
-    export -- True False whether to create a shapefile version in outDir.
-    """
-    years2 = str(tuple(range(years[0], years[1])))
-
-    print('SRID being used is 4326')
-    sql = """
-    /* Attach requests database */
-    ATTACH DATABASE '/Users/nmtarr/Documents/RANGES/Inputs/requests.sqlite'
-    AS requests;
-
-    /* Attach an occurrences database */
-    ATTACH DATABASE '/Users/nmtarr/Documents/RANGES/Outputs/{2}_occurrences.sqlite'
-    AS occs;
-
-    /* Create range map for the period. */
-    INSERT INTO range_polygons (rng_polygon_id, alias, species_id,
-                                months, years,
-                                method, date_created, range_4326,
-                                occurrences_4326)
-                    SELECT '{0}', '{1}', '{2}', '{3}', '{5}',
-                           'concave hull_{7}_{8}', date('now'),
-                            CASE
-                            WHEN (SELECT COUNT(circle_wgs84)
-                            FROM occs.occurrences
-                            WHERE cast(strftime('%m', occurrenceDate) AS INTEGER) IN {3}
-                            AND cast(strftime('%Y', occurrenceDate) AS INTEGER) IN {4}
-                            AND coordinateUncertaintyInMeters < {6})
-                            > 3 THEN ConcaveHull(CastToMultiPolygon(GUnion(circle_wgs84)),
-                                                 {7}, {8})
-                            ELSE NULL
-                            END range_4326,
-                            CastToMultiPolygon(GUnion(circle_wgs84))
-                    FROM occs.occurrences
-                    WHERE cast(strftime('%m', occurrenceDate) AS INTEGER) IN {3}
-                        AND cast(strftime('%Y', occurrenceDate) AS INTEGER) IN {4}
-                        AND coordinateUncertaintyInMeters < {6};
-
-    /* Update the range tolerance and min_count information */
-    UPDATE range_polygons
-    SET max_uncertainty_meters = '{6}';
-
-    /* Recover geometry */
-    SELECT RecoverGeometryColumn('range_polygons', 'range_4326', 4326,
-                                 'MULTIPOLYGON', 'XY');
-
-    SELECT RecoverGeometryColumn('range_polygons', 'occurrences_4326', 4326,
-                                 'MULTIPOLYGON', 'XY');
-
-    DETACH DATABASE requests;
-
-    DETACH DATABASE occs;
-    """.format(rng_poly_id, alias, sp_id, months, years2, years,
-                max_coordUncertainty, factor, allow_holes)
-
-    try:
-        conn = sqlite3.connect(config.eval_db)
+if __name__ == '__main__':
+    #############################################################################
+    #                              Species-concept
+    #############################################################################
+    os.chdir(codeDir)
+    # Get species info from requests database
+    conn2 = sqlite3.connect(inDir + 'requests.sqlite')
+    cursor2 = conn2.cursor()
+    sql_tax = """SELECT gbif_id, common_name, scientific_name,
+                        error_tolerance, gap_id, min_count, migratory
+                 FROM species_concepts
+                 WHERE species_id = '{0}';""".format(sp_id)
+    concept = cursor2.execute(sql_tax).fetchall()[0]
+    gbif_id = concept[0]
+    common_name = concept[1]
+    scientific_name = concept[2]
+    error_toler = concept[3]
+    gap_id = concept[4]
+    min_count = concept[5]
+    migratory = concept[6]
+
+
+    #############################################################################
+    #                          Connect to Database
+    #############################################################################
+    # Delete the database if it already exists
+    if os.path.exists(config.eval_db):
+        os.remove(config.eval_db)
+
+    # Create or connect to the database
+    conn = sqlite3.connect(config.eval_db)
+    os.putenv('SPATIALITE_SECURITY', 'relaxed')
+    conn.enable_load_extension(True)
+    conn.execute('SELECT load_extension("mod_spatialite")')
+    cursor = conn.cursor()
+
+    # Make db spatial
+    cursor.execute('SELECT InitSpatialMetadata();')
+
+    sql_rngy = """
+            /* Make a table for storing range maps for unique species-time period
+               combinations, needs GEOMETRY */
+            CREATE TABLE IF NOT EXISTS range_polygons (
+                         rng_polygon_id TEXT NOT NULL PRIMARY KEY,
+                         alias TEXT UNIQUE,
+                         species_id TEXT NOT NULL,
+                         months TEXT,
+                         years TEXT,
+                         method TEXT,
+                         max_uncertainty_meters INTEGER,
+                         min_count INTEGER,
+                         date_created TEXT
+                         );
+                """
+    cursor.executescript(sql_rngy)
+
+    sql_geom = """SELECT AddGeometryColumn('range_polygons', 'range_4326', 4326,
+                             'MULTIPOLYGON', 'XY');
+
+                  SELECT AddGeometryColumn('range_polygons', 'occurrences_4326', 4326,
+                             'MULTIPOLYGON', 'XY');"""
+    cursor.executescript(sql_geom)
+
+
+    #############################################################################
+    #                          Make Some Range Polygons
+    #############################################################################
+    def SpatialiteConnection(db=':memory:'):
+        """
+        Returns a connection to db with mod_spatialite loaded.
+        """
+        conn = sqlite3.connect(db)
         os.putenv('SPATIALITE_SECURITY', 'relaxed')
         conn.enable_load_extension(True)
         conn.execute('SELECT load_extension("mod_spatialite")')
-        cursor = conn.cursor()
-        cursor.executescript(sql)
-        del cursor
+        return conn
+
+    def MonthlyUnions(sp_id, years, max_uncertainty):
+        """
+        Unions the occurrence circles of each month.  Range polygons for any
+        period are built from these, so each circle is only unioned once.
+        Circles are unioned with repo_functions.cascaded_union, which splits
+        them into spatial partitions that are unioned in parallel and merged.
+
+        Returns a dictionary of month: (number of circles, union WKB).
+
+        Arguments:
+        sp_id -- species id for this project.  Must be in requests.species_concepts.
+        years -- tuple of start and end years to use.  Format as (1980,2000)
+        max_uncertainty -- max coordinate uncertainty to allow when filtering
+                                occurrences for use in polygon delineation.
+        """
+        years2 = str(tuple(range(years[0], years[1])))
+
+        sql = """
+        SELECT cast(strftime('%m', occurrenceDate) AS INTEGER) AS month,
+               AsBinary(circle_wgs84)
+        FROM occs.occurrences
+        WHERE cast(strftime('%Y', occurrenceDate) AS INTEGER) IN {0}
+            AND coordinateUncertaintyInMeters < {1}
+            AND circle_wgs84 IS NOT NULL;""".format(years2, max_uncertainty)
+
+        conn = SpatialiteConnection()
+        conn.execute("""ATTACH DATABASE
+                        '/Users/nmtarr/Documents/RANGES/Outputs/{0}_occurrences.sqlite'
+                        AS occs;""".format(sp_id))
+        circles = {}
+        for month, circle in conn.execute(sql):
+            circles.setdefault(month, []).append(circle)
+        conn.close()
+
+        return {month: (len(circles[month]),
+                        functions.cascaded_union(circles[month],
+                                                 workers=config.union_workers,
+                                                 partition_size=config.union_partition_size,
+                                                 coarsen=config.union_coarsen))
+                for month in circles}
+
+    def PeriodPolygons(months, monthly, factor=2, allow_holes=True):
+        """
+        Makes the occurrence polygon of a period (the union of its months'
+        unions) and its concave hull, which is only made if the period has more
+        than 3 circles.  Runs in its own in-memory database so periods can be
+        built at the same time in threads.
+
+        Returns (hull WKB or None, occurrence polygon WKB or None).
+
+        Arguments:
+        months -- tuple of months to include.  For example: (3,4,5,6,7)
+        monthly -- dictionary from MonthlyUnions.
+        factor -- factor to use in concave hull; defaults to 2.
+        allow_holes -- True or False for holes within the range.
+        """
+        parts = [monthly[x] for x in months if x in monthly]
+        if not parts:
+            return None, None
+        count = sum(x[0] for x in parts)
+
+        conn = SpatialiteConnection()
+        conn.execute("CREATE TABLE parts (geom BLOB);")
+        conn.executemany("INSERT INTO parts VALUES (GeomFromWKB(?, 4326));",
+                         [(x[1],) for x in parts])
+        hull, occurrences = conn.execute("""
+            SELECT CASE WHEN ? > 3 THEN AsBinary(ConcaveHull(geom, ?, ?))
+                        ELSE NULL END,
+                   AsBinary(geom)
+            FROM (SELECT CastToMultiPolygon(GUnion(geom)) AS geom FROM parts);""",
+            (count, factor, int(allow_holes))).fetchone()
         conn.close()
-    except Exception as e:
-        print(e)
-        print(sql)
+        return hull, occurrences
+
+    def MakeConcaveHulls(periods, sp_id, years, max_uncertainty, outDir, export,
+                         factor=2, allow_holes=True, workers=4):
+        """
+        Function for creating range polygon entries in range_eval.range_polygons
+        for several periods.  The circles of each month are unioned once
+        (MonthlyUnions), then each period's polygons are made from the monthly
+        unions, with periods built in parallel.
+
+        Arguments:
+        periods -- dictionary of alias: months for the periods to make.  The
+                alias is the keyword to use for filenames and shorthand
+                reference to the polygon, and 'rng' + alias is its unique ID.
+                Months are formatted like '(3,4,5,6,7)'.
+        sp_id -- species id for this project.  Must be in requests.species_concepts.
+        years -- tuple of start and end years to use.  Format as (1980,2000)
+        max_uncertainty -- max coordinate uncertainty to allow when filtering
+                                occurrences for use in polygon delineation.
+        outDir -- working directory, where to put the output.
+        export -- True False whether to create a shapefile version in outDir.
+        factor -- factor to use in concave hull; defaults to 2.
+        allow_holes -- True or False for holes within the range.
+        workers -- number of periods to build at once.
+        """
+        from concurrent.futures import ThreadPoolExecutor
+
+        print('SRID being used is 4326')
+        monthly = MonthlyUnions(sp_id, years, max_uncertainty)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = {alias: executor.submit(PeriodPolygons,
+                                              tuple(int(x) for x in
+                                                    months.strip('()').split(',')),
+                                              monthly, factor, allow_holes)
+                       for alias, months in periods.items()}
+            polygons = {alias: futures[alias].result() for alias in futures}
+
+        conn = SpatialiteConnection(config.eval_db)
+        conn.executemany("""
+            /* Create range map for the period. */
+            INSERT INTO range_polygons (rng_polygon_id, alias, species_id,
+                                        months, years, method, date_created,
+                                        range_4326, occurrences_4326)
+            VALUES (?, ?, ?, ?, ?, ?, date('now'),
+                    CastToMultiPolygon(GeomFromWKB(?, 4326)),
+                    CastToMultiPolygon(GeomFromWKB(?, 4326)));""",
+            [('rng' + alias, alias, sp_id, periods[alias], str(years),
+              'concave hull_{0}_{1}'.format(factor, allow_holes)) +
+             polygons[alias] for alias in periods])
+        conn.executescript("""
+        /* Update the range tolerance and min_count information */
+        UPDATE range_polygons
+        SET max_uncertainty_meters = '{0}';
+
+        /* Recover geometry */
+        SELECT RecoverGeometryColumn('range_polygons', 'range_4326', 4326,
+                                     'MULTIPOLYGON', 'XY');
 
-    if export == True:
+        SELECT RecoverGeometryColumn('range_polygons', 'occurrences_4326', 4326,
+                                     'MULTIPOLYGON', 'XY');
+        """.format(max_uncertainty))
+        conn.close()
+
+        if export == True:
+            for alias in periods:
+                ExportRangePolygon(alias, outDir)
+        return
+
+    def ExportRangePolygon(alias, outDir):
+        """
+        Exports a period's range and occurrence polygons from range_polygons to
+        shapefiles in outDir.
+        """
         sqlExp = """
         /* Pull out the period for mapping */
         CREATE TABLE temp1 AS SELECT * FROM range_polygons
@@ -214,110 +286,91 @@ def MakeConcaveHull(rng_poly_id, alias, sp_id, months, years,
         DROP TABLE temp1;""".format(alias, outDir)
 
         try:
-            conn = sqlite3.connect(config.eval_db)
-            os.putenv('SPATIALITE_SECURITY', 'relaxed')
-            conn.enable_load_extension(True)
-            conn.execute('SELECT load_extension("mod_spatialite")')
-            cursor = conn.cursor()
-            cursor.executescript(sqlExp)
+            conn = SpatialiteConnection(config.eval_db)
+            conn.executescript(sqlExp)
             conn.close()
         except:
             print(sqlExp)
 
-    return
-
-# Make occurrence shapefiles for each month, if migratory
-month_dict = {'january': '(1)', 'february':'(2)', 'march':'(3)', 'april':'(4)',
-              'may':'(5)', 'june':'(6)', 'july':'(7)', 'august':'(8)',
-              'september':'(9)', 'october':'(10)', 'november':'(11)',
-              'december':'(12)'}
-
-if migratory == '1':
-    for month in list(month_dict.keys()):
-        print(month)
-        MakeConcaveHull(rng_poly_id='rng' + month, alias=month, sp_id=sp_id,
-                        months=month_dict[month],
-                        years=year_range,
-                        max_uncertainty=max_coordUncertainty,
-                        outDir=outDir, export=True)
-
-# Make range shapefiles for each season, display them too
-period_dict = {"summer": '(5,6,7,8)',
-               "winter": '(11,12,1,2)',
-               "spring": '(3,4,5)',
-               "fall": '(8,9,10,11)',
-               "yearly": '(1,2,3,4,5,6,7,8,9,10,11,12)'}
-
-if migratory == "1":
-    for period in period_dict:
-        print(period)
-        MakeConcaveHull(rng_poly_id='rng' + period, alias=period, sp_id=sp_id,
-                        months=period_dict[period],
-                        years=year_range,
-                        max_uncertainty=max_coordUncertainty,
-                        outDir=outDir, export=True)
-else:
-    MakeConcaveHull(rng_poly_id='rng' + 'yearly', alias='yearly', sp_id=sp_id,
-                    months=period_dict['yearly'],
-                    years=year_range,
-                    max_uncertainty=max_coordUncertainty,
-                    outDir=outDir, export=True)
-
-
-#############################################################################
-#                    Display Seasonal Range Maps
-#############################################################################
-"""
-season_colors = {'fall': 'red', 'winter': 'white', 'summer': 'magenta',
-                    'spring': 'blue'}
-for period in list(season_colors.keys()):
-     title = "Yellow-billed Cuckoo occurrence polygons (1970-2018) - {0}".format(period)
-
-    # Packages needed for plotting
-    import matplotlib.pyplot as plt
-    from mpl_toolkits.basemap import Basemap
-    import numpy as np
-    from matplotlib.patches import Polygon
-    from matplotlib.collections import PatchCollection
-    from matplotlib.patches import PathPatch
-
-    shp1 = {'file': '{0}{1}_range'.format(outDir, period),
-            'drawbounds': False, 'linewidth': .5, 'linecolor': 'y',
-            'fillcolor': 'y'}
-
-    # Display occurrence polygons
-    map_these=[shp1]
-
-    # Basemap
-    fig = plt.figure(figsize=(12,8))
-    ax = plt.subplot(1,1,1)
-    map = Basemap(projection='aea', resolution='i', lon_0=-95.5, lat_0=39.5,
-                  height=3400000, width=5000000)
-    map.drawcoastlines(color='grey')
-    map.drawstates(color='grey')
-    map.drawcountries(color='grey')
-    map.fillcontinents(color='green',lake_color='aqua')
-    map.drawmapboundary(fill_color='aqua')
-
-    for mapfile in map_these:
-        # Add shapefiles to the map
-        if mapfile['fillcolor'] == None:
-            map.readshapefile(mapfile['file'], 'mapfile',
-                              drawbounds=mapfile['drawbounds'],
-                              linewidth=mapfile['linewidth'],
-                              color=mapfile['linecolor'])
-        else:
-            map.readshapefile(mapfile['file'], 'mapfile',
-                      drawbounds=mapfile['drawbounds'])
-            # Code for extra formatting -- filling in polygons setting border
-            # color
-            patches = []
-            for info, shape in zip(map.mapfile_info, map.mapfile):
-                patches.append(Polygon(np.array(shape), True))
-            ax.add_collection(PatchCollection(patches,
-                                              facecolor= mapfile['fillcolor'],
-                                              edgecolor=mapfile['linecolor'],
-                                              linewidths=mapfile['linewidth'],
-                                              zorder=2))
-    fig.suptitle(title, fontsize=20)
-"""
+    # Make occurrence shapefiles for each month, if migratory
+    month_dict = {'january': '(1)', 'february':'(2)', 'march':'(3)', 'april':'(4)',
+                  'may':'(5)', 'june':'(6)', 'july':'(7)', 'august':'(8)',
+                  'september':'(9)', 'october':'(10)', 'november':'(11)',
+                  'december':'(12)'}
+
+    # Make range shapefiles for each season, display them too
+    period_dict = {"summer": '(5,6,7,8)',
+                   "winter": '(11,12,1,2)',
+                   "spring": '(3,4,5)',
+                   "fall": '(8,9,10,11)',
+                   "yearly": '(1,2,3,4,5,6,7,8,9,10,11,12)'}
+
+    # All periods come from one set of monthly unions
+    if migratory == "1":
+        periods = dict(month_dict)
+        periods.update(period_dict)
+    else:
+        periods = {'yearly': period_dict['yearly']}
+
+    MakeConcaveHulls(periods, sp_id=sp_id, years=year_range,
+                     max_uncertainty=max_coordUncertainty, outDir=outDir,
+                     export=True, workers=config.hull_workers)
+
+
+    #############################################################################
+    #                    Display Seasonal Range Maps
+    #############################################################################
+    """
+    season_colors = {'fall': 'red', 'winter': 'white', 'summer': 'magenta',
+                        'spring': 'blue'}
+    for period in list(season_colors.keys()):
+         title = "Yellow-billed Cuckoo occurrence polygons (1970-2018) - {0}".format(period)
+
+        # Packages needed for plotting
+        import matplotlib.pyplot as plt
+        from mpl_toolkits.basemap import Basemap
+        import numpy as np
+        from matplotlib.patches import Polygon
+        from matplotlib.collections import PatchCollection
+        from matplotlib.patches import PathPatch
+
+        shp1 = {'file': '{0}{1}_range'.format(outDir, period),
+                'drawbounds': False, 'linewidth': .5, 'linecolor': 'y',
+                'fillcolor': 'y'}
+
+        # Display occurrence polygons
+        map_these=[shp1]
+
+        # Basemap
+        fig = plt.figure(figsize=(12,8))
+        ax = plt.subplot(1,1,1)
+        map = Basemap(projection='aea', resolution='i', lon_0=-95.5, lat_0=39.5,
+                      height=3400000, width=5000000)
+        map.drawcoastlines(color='grey')
+        map.drawstates(color='grey')
+        map.drawcountries(color='grey')
+        map.fillcontinents(color='green',lake_color='aqua')
+        map.drawmapboundary(fill_color='aqua')
+
+        for mapfile in map_these:
+            # Add shapefiles to the map
+            if mapfile['fillcolor'] == None:
+                map.readshapefile(mapfile['file'], 'mapfile',
+                                  drawbounds=mapfile['drawbounds'],
+                                  linewidth=mapfile['linewidth'],
+                                  color=mapfile['linecolor'])
+            else:
+                map.readshapefile(mapfile['file'], 'mapfile',
+                          drawbounds=mapfile['drawbounds'])
+                # Code for extra formatting -- filling in polygons setting border
+                # color
+                patches = []
+                for info, shape in zip(map.mapfile_info, map.mapfile):
+                    patches.append(Polygon(np.array(shape), True))
+                ax.add_collection(PatchCollection(patches,
+                                                  facecolor= mapfile['fillcolor'],
+                                                  edgecolor=mapfile['linecolor'],
+                                                  linewidths=mapfile['linewidth'],
+                                                  zorder=2))
+        fig.suptitle(title, fontsize=20)
+    """
@@ -0,0 +1,25 @@
+"""
+Downloads the GAP ranges of every species in the species_concepts table of
+the parameters database into inDir, several at a time.  Ranges that are
+already downloaded and match ScienceBase's checksum are skipped, so this can
+be rerun to pick up new species or updated ranges before batch runs of
+retrieve_occurrences.py.
+"""
+import sqlite3
+import config
+import repo_functions as functions
+
+conn = sqlite3.connect(config.codeDir + 'parameters.sqlite')
+gap_ids = [x[0] for x in conn.execute("""SELECT DISTINCT gap_id
+                                         FROM species_concepts
+                                         WHERE gap_id IS NOT NULL;""")]
+conn.close()
+
+ranges = functions.prefetch_GAP_ranges(gap_ids, config.inDir,
+                                       workers=config.gap_workers)
+
+failed = {x: ranges[x] for x in ranges if isinstance(ranges[x], Exception)}
+print("{0} GAP ranges ready, {1} failed".format(len(ranges) - len(failed),
+                                                len(failed)))
+for gap_id in sorted(failed):
+    print("{0}: {1}".format(gap_id, failed[gap_id]))
@@ -209,33 +209,2192 @@ def MapShapefilePolygons_NC(map_these, title):
     plt.title(title, fontsize=20, pad=-40, backgroundcolor='w')
     return
 
-def download_GAP_range_CONUS2001v1(gap_id, toDir):
+def file_md5(path):
+    """
+    Returns the md5 hex digest of a file, read in 1 MB blocks.
+
+    (str) -> str
+    """
+    import hashlib
+
+    digest = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def download_GAP_range_CONUS2001v1(gap_id, toDir, sb=None, refresh=False):
     """
     Downloads GAP Range CONUS 2001 v1 file and returns path to the unzipped
     file.  NOTE: doesn't include extension in returned path so that you can
     specify if you want csv or shp or xml when you use the path.
+
+    Downloads are cached in toDir.  A manifest, <gap_id>_range_cache.json,
+    records the ScienceBase item, the remote file's checksum and the files
+    extracted from the zip.  When the remote checksum matches the manifest,
+    the zip matches it and the extracted files are all present, nothing is
+    downloaded or extracted.  The manifest also keeps the item id so later
+    runs skip the ScienceBase search, and if ScienceBase can't be reached a
+    cached range is used as is.
+
+    Arguments:
+    gap_id -- GAP species code, e.g. 'bybcux'.
+    toDir -- directory to download to and extract in.
+    sb -- ScienceBase session (sciencebasepy.SbSession, or an object with the
+          same find_items_by_any_text, get_item and download_file methods).
+    refresh -- download and extract even if the cache is valid.
     """
-    import sciencebasepy
+    import json
+    import os
     import zipfile
 
-    # Connect
-    sb = sciencebasepy.SbSession()
-
-    # Search for gap range item in ScienceBase
     gap_id = gap_id[0] + gap_id[1:5].upper() + gap_id[5]
-    item_search = '{0}_CONUS_2001v1 Range Map'.format(gap_id)
-    items = sb.find_items_by_any_text(item_search)
+    manifest_file = os.path.join(toDir, '{0}_range_cache.json'.format(gap_id))
+    manifest = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+
+    def cached_path():
+        # Path of the cached range if the manifest's files are all there.
+        if not manifest:
+            return None
+        paths = [os.path.join(toDir, x) for x in manifest['extracted']]
+        if not all(os.path.exists(x) for x in paths):
+            return None
+        return os.path.join(toDir, manifest['zip']).replace('.zip', '')
+
+    # Connect
+    if sb is None:
+        import sciencebasepy
+        sb = sciencebasepy.SbSession()
+    sciencebase = 'www.sciencebase.gov'
 
+    # Search for gap range item in ScienceBase, unless it's already known.
     # Get a public item.  No need to log in.
-    rng =  items['items'][0]['id']
-    item_json = sb.get_item(rng)
-    get_files = sb.get_item_files(item_json, toDir)
+    try:
+        rng = manifest.get('item_id')
+        if rng is None:
+            item_search = '{0}_CONUS_2001v1 Range Map'.format(gap_id)
+            items = request_governor.call(sciencebase,
+                                          sb.find_items_by_any_text,
+                                          item_search)
+            rng = items['items'][0]['id']
+        item_json = request_governor.call(sciencebase, sb.get_item, rng)
+    except Exception as e:
+        if cached_path() is None:
+            raise
+        print("Using cached range for {0}; ScienceBase wasn't reached: {1}"
+              .format(gap_id, e))
+        return cached_path()
+
+    remote = item_json['files'][0]
+    checksum = (remote.get('checksum') or {}).get('value')
+    rng_zip = os.path.join(toDir, remote['name'])
+    if (not refresh and cached_path() is not None
+            and manifest.get('checksum') == checksum
+            and os.path.exists(rng_zip)
+            and (checksum is None or file_md5(rng_zip) == checksum)):
+        return cached_path()
+
+    # Download to a temporary name and check it before replacing the zip
+    partial = remote['name'] + '.part'
+    request_governor.call(sciencebase, sb.download_file, remote['url'],
+                          partial, toDir)
+    if checksum is not None and file_md5(os.path.join(toDir, partial)) != checksum:
+        os.remove(os.path.join(toDir, partial))
+        raise IOError("Checksum of {0} from ScienceBase doesn't match"
+                      .format(remote['name']))
+    os.replace(os.path.join(toDir, partial), rng_zip)
 
     # Unzip
-    rng_zip = toDir + item_json['files'][0]['name']
     zip_ref = zipfile.ZipFile(rng_zip, 'r')
     zip_ref.extractall(toDir)
+    extracted = zip_ref.namelist()
     zip_ref.close()
 
+    with open(manifest_file, 'w') as f:
+        json.dump({'gap_id': gap_id, 'item_id': rng, 'zip': remote['name'],
+                   'checksum': checksum, 'extracted': extracted}, f)
+
     # Return path to range file without extension
     return rng_zip.replace('.zip', '')
+
+def prefetch_GAP_ranges(gap_ids, toDir, workers=4, sb=None, refresh=False):
+    """
+    Downloads GAP ranges for many species at once, with 'workers' threads,
+    through download_GAP_range_CONUS2001v1's cache, so ranges that are
+    already current aren't downloaded again.  ScienceBase requests are paced
+    by request_governor.
+
+    Returns a dictionary of gap_id: path to the range without extension, or
+    the exception raised for that species.
+
+    (list of str, str, int, SbSession, bool) -> dict
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    if sb is None:
+        import sciencebasepy
+        sb = sciencebasepy.SbSession()
+
+    ranges = {}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {gap_id: executor.submit(download_GAP_range_CONUS2001v1,
+                                           gap_id, toDir, sb, refresh)
+                   for gap_id in set(gap_ids)}
+        for gap_id, future in futures.items():
+            try:
+                ranges[gap_id] = future.result()
+            except Exception as e:
+                ranges[gap_id] = e
+    return ranges
+
+def reprojected_GAP_range(gap_id, range_path, cache_db, srid=4326,
+                          shp_path=None):
+    """
+    Returns a GAP range (EPSG:5070 shapefile from
+    download_GAP_range_CONUS2001v1) reprojected to 'srid', from a cache
+    database of reprojected ranges keyed by gap_id, a hash of the
+    shapefile's files and the SRID.  The range is only imported and
+    transformed when it isn't cached; older versions of it in the same SRID
+    are replaced.  Geometries are stored as WKB.  SRID 102008 (Albers, as
+    used for the range evaluation databases) is registered in the cache.
+
+    If shp_path is given, the range is also exported there as a shapefile
+    (e.g., for MapShapefilePolygons), unless the cache records that it
+    already was for the same key and the shapefile still exists.
+
+    (str, str, str, int, str) ->
+        list of (HUC12RNG, seasonCode, seasonName, WKB)
+
+    Arguments:
+    gap_id -- GAP species code.
+    range_path -- range shapefile, without extension.
+    cache_db -- path of the cache database.
+    srid -- SRID to reproject to.
+    shp_path -- where to export a shapefile, without extension.
+    """
+    import os
+    import sqlite3
+
+    gap_id = gap_id[0] + gap_id[1:5].upper() + gap_id[5]
+    source_hash = file_hash([range_path + x for x in ('.shp', '.shx', '.dbf',
+                                                      '.prj')])
+    key = (gap_id, source_hash, srid)
+
+    new_db = not os.path.exists(cache_db)
+    conn = sqlite3.connect(cache_db, timeout=60)
+    os.putenv('SPATIALITE_SECURITY', 'relaxed')
+    conn.enable_load_extension(True)
+    conn.execute('SELECT load_extension("mod_spatialite")')
+    if new_db:
+        conn.execute("SELECT InitSpatialMetadata(1);")
+    if not conn.execute("""SELECT COUNT(*) FROM spatial_ref_sys
+                           WHERE srid = 102008;""").fetchone()[0]:
+        conn.execute(sql_albers_srid)
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS gap_ranges (gap_id TEXT,
+                                               source_hash TEXT,
+                                               srid INTEGER,
+                                               HUC12RNG TEXT,
+                                               seasonCode INTEGER,
+                                               seasonName TEXT,
+                                               geom BLOB);
+
+        CREATE INDEX IF NOT EXISTS gap_ranges_key
+            ON gap_ranges (gap_id, source_hash, srid);
+
+        CREATE TABLE IF NOT EXISTS gap_range_exports
+            (shp_path TEXT PRIMARY KEY, gap_id TEXT, source_hash TEXT,
+             srid INTEGER);
+        """)
+
+    cached = conn.execute("""SELECT COUNT(*) FROM gap_ranges
+                             WHERE gap_id = ? AND source_hash = ?
+                             AND srid = ?;""", key).fetchone()[0]
+    if not cached:
+        conn.execute("DELETE FROM gap_ranges WHERE gap_id = ? AND srid = ?;",
+                     (gap_id, srid))
+        conn.executescript("""
+            SELECT ImportSHP('{0}', 'rng_import', 'utf-8', 5070,
+                             'geom_5070', 'HUC12RNG', 'MULTIPOLYGON');
+
+            INSERT INTO gap_ranges
+                SELECT '{1}', '{2}', {3}, HUC12RNG, seasonCode, seasonName,
+                       AsBinary(Transform(geom_5070, {3}))
+                FROM rng_import;
+
+            SELECT DiscardGeometryColumn('rng_import', 'geom_5070');
+
+            DROP TABLE rng_import;
+            """.format(range_path, gap_id, source_hash, srid))
+        conn.commit()
+
+    if shp_path is not None:
+        exported = conn.execute("""SELECT gap_id, source_hash, srid
+                                   FROM gap_range_exports
+                                   WHERE shp_path = ?;""",
+                                (shp_path,)).fetchone()
+        if exported != key or not os.path.exists(shp_path + '.shp'):
+            conn.executescript("""
+                CREATE TABLE rng_export AS
+                    SELECT HUC12RNG, seasonCode, seasonName,
+                           CastToMultiPolygon(GeomFromWKB(geom, {3})) AS geom
+                    FROM gap_ranges
+                    WHERE gap_id = '{0}' AND source_hash = '{1}'
+                    AND srid = {3};
+
+                SELECT RecoverGeometryColumn('rng_export', 'geom', {3},
+                                             'MULTIPOLYGON', 'XY');
+
+                SELECT ExportSHP('rng_export', 'geom', '{2}', 'utf-8');
+
+                SELECT DiscardGeometryColumn('rng_export', 'geom');
+
+                DROP TABLE rng_export;
+                """.format(gap_id, source_hash, shp_path, srid))
+            conn.execute("""INSERT OR REPLACE INTO gap_range_exports
+                            VALUES (?, ?, ?, ?);""", (shp_path,) + key)
+            conn.commit()
+
+    rows = conn.execute("""SELECT HUC12RNG, seasonCode, seasonName, geom
+                           FROM gap_ranges
+                           WHERE gap_id = ? AND source_hash = ?
+                           AND srid = ?;""", key).fetchall()
+    conn.close()
+    return rows
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter.  take() blocks until a token is available.
+    Tokens are added at 'rate' per second, up to 'burst' tokens.
+
+    Arguments:
+    rate -- sustained requests per second.
+    burst -- number of requests that can be made at once after idling.
+    """
+    def __init__(self, rate, burst=None):
+        import threading
+        import time
+
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        import time
+
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class RequestGovernor(object):
+    """
+    Shared gatekeeper for outbound web service calls (GBIF, ScienceBase).
+    Every call goes through call(), which:
+
+    - waits for a token from the host's token bucket,
+    - waits until fewer than 'limit' calls are in flight, where the limit
+      grows by one for every 'limit' successful calls and is cut in half when
+      the service throttles (429 or 503), i.e. AIMD,
+    - retries throttled, server error (5xx), timed out, and connection
+      failed calls with jittered exponential backoff (or the server's
+      Retry-After, when given), unless the call isn't safe to repeat,
+    - records metrics: requests, retries, throttles, failures, and a latency
+      histogram.
+
+    Arguments:
+    host_rates -- dictionary of host names to requests per second.  Hosts
+                  that aren't listed aren't rate limited.
+    max_concurrency -- upper bound for the AIMD concurrency limit.
+    min_concurrency -- lower bound for the AIMD concurrency limit.
+    max_retries -- retries before the error is raised.
+    base_delay -- seconds to wait before the first retry; doubles each retry.
+    max_delay -- longest wait between retries, in seconds.
+    timeout -- seconds callers should pass as the request timeout.
+    """
+    latency_buckets = (0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60)
+    throttle_codes = (429, 503)
+    retry_codes = (429, 500, 502, 503, 504)
+
+    def __init__(self, host_rates=None, max_concurrency=16, min_concurrency=1,
+                 max_retries=6, base_delay=1., max_delay=120., timeout=60):
+        import threading
+
+        self.buckets = dict((host, TokenBucket(rate))
+                            for host, rate in (host_rates or {}).items())
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.limit = float(min(4, max_concurrency))
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.in_flight = 0
+        self.condition = threading.Condition()
+        self.counts = {'requests': 0, 'retries': 0, 'throttles': 0,
+                       'failures': 0}
+        self.latencies = [0] * (len(self.latency_buckets) + 1)
+
+    @staticmethod
+    def status_of(error):
+        """
+        Returns the HTTP status code carried by a requests exception, or None.
+        """
+        response = getattr(error, 'response', None)
+        return getattr(response, 'status_code', None)
+
+    def is_retryable(self, error):
+        status = self.status_of(error)
+        if status is not None:
+            return status in self.retry_codes
+        # Timeouts and dropped connections don't carry a response
+        return type(error).__name__ in ('Timeout', 'ConnectTimeout',
+                                        'ReadTimeout', 'ConnectionError',
+                                        'ChunkedEncodingError')
+
+    def retry_delay(self, error, attempt):
+        import random
+
+        response = getattr(error, 'response', None)
+        headers = getattr(response, 'headers', None) or {}
+        try:
+            return min(self.max_delay, float(headers['Retry-After']))
+        except (KeyError, ValueError, TypeError):
+            pass
+        return random.uniform(0, min(self.max_delay,
+                                     self.base_delay * 2 ** attempt))
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, throttled):
+        with self.condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.min_concurrency, self.limit / 2.)
+            else:
+                self.limit = min(self.max_concurrency,
+                                 self.limit + 1. / self.limit)
+            self.condition.notify_all()
+
+    def record_latency(self, seconds):
+        import bisect
+
+        with self.condition:
+            self.latencies[bisect.bisect_left(self.latency_buckets,
+                                              seconds)] += 1
+
+    def call(self, host, func, *args, retry=True, **kwargs):
+        """
+        Calls func(*args, **kwargs) under the governor's rate, concurrency,
+        and retry rules and returns its result.  Pass retry=False for calls
+        that aren't idempotent (e.g. a POST that creates something), since a
+        5xx or timeout doesn't mean the server didn't act on the request.
+
+        (str, callable, ...) -> result of func
+        """
+        import time
+
+        attempt = 0
+        while True:
+            if host in self.buckets:
+                self.buckets[host].take()
+            self.acquire()
+            throttled = False
+            start = time.time()
+            try:
+                with self.condition:
+                    self.counts['requests'] += 1
+                return func(*args, **kwargs)
+            except Exception as e:
+                throttled = self.status_of(e) in self.throttle_codes
+                if throttled:
+                    with self.condition:
+                        self.counts['throttles'] += 1
+                if (not retry or not self.is_retryable(e) or
+                        attempt >= self.max_retries):
+                    with self.condition:
+                        self.counts['failures'] += 1
+                    raise
+                error = e
+            finally:
+                self.record_latency(time.time() - start)
+                self.release(throttled)
+            with self.condition:
+                self.counts['retries'] += 1
+            time.sleep(self.retry_delay(error, attempt))
+            attempt += 1
+
+    def metrics(self):
+        """
+        Returns a dictionary of request counts, the current concurrency limit,
+        and the latency histogram (upper bound in seconds -> count).
+
+        () -> dict
+        """
+        with self.condition:
+            metrics = dict(self.counts)
+            metrics['concurrency_limit'] = int(self.limit)
+            bounds = [str(x) for x in self.latency_buckets] + ['inf']
+            metrics['latency'] = dict(zip(bounds, self.latencies))
+        return metrics
+
+# Governor used for all GBIF and ScienceBase calls in this module.
+request_governor = RequestGovernor(host_rates={'api.gbif.org': 10,
+                                               'www.sciencebase.gov': 5})
+
+class GBIFCache(object):
+    """
+    Persistent cache of GBIF occurrence search responses, stored in an sqlite
+    database.  Responses are keyed on the taxon key and the resolved search
+    parameters (including offset and limit) and stored as zlib-compressed
+    json.  When the cache grows past max_mb the least recently used responses
+    are evicted.  Responses older than ttl_days are treated as missing, and
+    refresh=True ignores cached responses altogether (they are still
+    replaced with the new download).
+
+    The cache can be shared by the threads in get_GBIF_pages.
+
+    Arguments:
+    path -- path to the cache database; created if it doesn't exist.
+    max_mb -- size cap for the stored (compressed) responses, in megabytes.
+    ttl_days -- age in days after which a response is re-downloaded.  None
+                means responses don't expire.
+    refresh -- True to re-download every response on this run.
+    """
+    def __init__(self, path, max_mb=1000, ttl_days=None, refresh=False):
+        import sqlite3
+        import threading
+
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl_seconds = None if ttl_days is None else ttl_days * 86400
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                 key TEXT NOT NULL PRIMARY KEY,
+                                 params TEXT,
+                                 payload BLOB,
+                                 size INTEGER,
+                                 created REAL,
+                                 accessed REAL);""")
+        self.conn.execute("""CREATE INDEX IF NOT EXISTS responses_accessed
+                             ON responses (accessed);""")
+        self.conn.commit()
+        # Running total of the stored sizes, kept up to date by put()
+        self.total = self.conn.execute("""SELECT COALESCE(SUM(size), 0)
+                                          FROM responses;""").fetchone()[0]
+
+    @staticmethod
+    def make_key(gbif_id, params):
+        """
+        Returns the cache key and the canonical json string of a request.
+
+        (str, dict) -> (str, str)
+        """
+        import hashlib
+        import json
+
+        request = dict(params)
+        request['gbif_id'] = gbif_id
+        text = json.dumps(request, sort_keys=True, default=str)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest(), text
+
+    def get(self, gbif_id, params):
+        """
+        Returns the cached response for a request, or None.
+
+        (str, dict) -> dict or None
+        """
+        import json
+        import time
+        import zlib
+
+        key = self.make_key(gbif_id, params)[0]
+        with self.lock:
+            row = None
+            if not self.refresh:
+                row = self.conn.execute("""SELECT payload, created
+                                           FROM responses WHERE key = ?;""",
+                                        (key,)).fetchone()
+            now = time.time()
+            if row is None or (self.ttl_seconds is not None and
+                               now - row[1] > self.ttl_seconds):
+                self.misses += 1
+                return None
+            self.conn.execute("UPDATE responses SET accessed = ? WHERE key = ?;",
+                              (now, key))
+            self.conn.commit()
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]).decode('utf-8'))
+
+    def put(self, gbif_id, params, response):
+        """
+        Stores a response and evicts the least recently used responses if the
+        cache is over its size cap.
+
+        (str, dict, dict) -> None
+        """
+        import json
+        import time
+        import zlib
+
+        key, text = self.make_key(gbif_id, params)
+        payload = zlib.compress(json.dumps(response).encode('utf-8'))
+        now = time.time()
+        with self.lock:
+            replaced = self.conn.execute("""SELECT size FROM responses
+                                            WHERE key = ?;""",
+                                         (key,)).fetchone()
+            self.conn.execute("""INSERT OR REPLACE INTO responses
+                                 (key, params, payload, size, created, accessed)
+                                 VALUES (?, ?, ?, ?, ?, ?);""",
+                              (key, text, payload, len(payload), now, now))
+            self.total += len(payload) - (replaced[0] if replaced else 0)
+            if self.total > self.max_bytes:
+                evict = []
+                rows = self.conn.execute("""SELECT key, size FROM responses
+                                            ORDER BY accessed;""")
+                for old_key, size in rows:
+                    if self.total <= self.max_bytes:
+                        break
+                    evict.append((old_key,))
+                    self.total -= size
+                self.conn.executemany("DELETE FROM responses WHERE key = ?;",
+                                      evict)
+            self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+def search_GBIF(gbif_id, search_params, cache=None, **page_params):
+    """
+    Runs pygbif's occurrences.search through the request governor, going
+    through a GBIFCache if one is given.
+
+    (str, dict, GBIFCache, ...) -> dict
+
+    Arguments:
+    gbif_id -- GBIF taxon key of the species.
+    search_params -- dictionary of keyword arguments for occurrences.search.
+    cache -- optional GBIFCache.
+    page_params -- additional keyword arguments, such as limit and offset.
+    """
+    from pygbif import occurrences
+
+    params = dict(search_params, **page_params)
+    if cache is not None:
+        response = cache.get(gbif_id, params)
+        if response is not None:
+            return response
+    response = request_governor.call('api.gbif.org', occurrences.search,
+                                     gbif_id,
+                                     timeout=request_governor.timeout,
+                                     **params)
+    if cache is not None:
+        cache.put(gbif_id, params, response)
+    return response
+
+def get_GBIF_pages(gbif_id, occ_count, search_params, page_size=300,
+                   workers=None, cache=None, skip=()):
+    """
+    Requests occurrence records from GBIF in pages of page_size records and
+    yields the pages in offset order.  Up to 'workers' page requests are in
+    flight at once on a thread pool; a page that finishes early is held until
+    the pages before it have been yielded.
+
+    (str, int, dict, int, int) -> generator of (offset, list of dicts)
+
+    Arguments:
+    gbif_id -- GBIF taxon key of the species.
+    occ_count -- total number of records to page through, usually the 'count'
+                 from an initial occurrences.search with the same parameters.
+    search_params -- dictionary of keyword arguments for occurrences.search,
+                     e.g. {'year': '1999,2020', 'month': '1,12'}.
+    page_size -- number of records per request.  300 is the GBIF maximum.
+    workers -- number of page request threads.  Defaults to the request
+               governor's maximum concurrency; the governor decides how many
+               of them actually run at once.
+    cache -- optional GBIFCache to read pages from and save pages to.
+    skip -- offsets of pages that don't need to be retrieved.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from collections import deque
+
+    def get_page(offset):
+        occ_json = search_GBIF(gbif_id, search_params, cache=cache,
+                               limit=page_size, offset=offset)
+        return occ_json['results']
+
+    workers = max(1, workers or request_governor.max_concurrency)
+    skip = set(skip)
+    offsets = iter([x for x in range(0, occ_count, page_size)
+                    if x not in skip])
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        # Keep the pool full, but never more than 'workers' pages ahead
+        for offset in offsets:
+            pending.append((offset, pool.submit(get_page, offset)))
+            if len(pending) >= workers:
+                break
+        while pending:
+            offset, future = pending.popleft()
+            page = future.result()
+            next_offset = next(offsets, None)
+            if next_offset is not None:
+                pending.append((next_offset, pool.submit(get_page,
+                                                         next_offset)))
+            yield offset, page
+
+def split_omit_list(value):
+    """
+    Converts an omit list from the gbif_filters table (a comma-space separated
+    string or NULL) into a set for membership tests.
+
+    (str or None) -> set
+    """
+    if type(value) == str:
+        return set(value.split(', '))
+    return set([])
+
+class GBIFFilter(object):
+    """
+    Compiled form of a row from the gbif_filters table.  The omit lists are
+    parsed into sets once, and every criterion is checked in a single pass
+    over each record.  A record is attributed to the first criterion that
+    rejects it (in the order of GBIFFilter.criteria), and counts of dropped
+    records are kept in the 'dropped' dictionary.
+
+    Arguments:
+    filter_row -- dictionary of gbif_filters column names and values.
+    """
+    criteria = ('has_coordinate_uncertainty', 'max_coordinate_uncertainty',
+                'collection_codes_omit', 'institutions_omit', 'bases_omit',
+                'protocols_omit', 'issues_omit', 'sampling_protocols_omit')
+
+    def __init__(self, filter_row):
+        self.row = filter_row
+        self.filter_id = filter_row.get('filter_id')
+        self.require_uncertainty = filter_row['has_coordinate_uncertainty'] == 1
+        self.max_uncertainty = filter_row['max_coordinate_uncertainty']
+        self.collections = split_omit_list(filter_row['collection_codes_omit'])
+        self.institutions = split_omit_list(filter_row['institutions_omit'])
+        self.bases = split_omit_list(filter_row['bases_omit'])
+        self.protocols = split_omit_list(filter_row['protocols_omit'])
+        self.issues = split_omit_list(filter_row['issues_omit'])
+        self.sampling = split_omit_list(filter_row['sampling_protocols_omit'])
+        self.kept = 0
+        self.dropped = dict((x, 0) for x in self.criteria)
+
+    @classmethod
+    def from_database(cls, cursor, filter_id):
+        """
+        Builds the filter from the gbif_filters table of the parameters
+        database that cursor is connected to.
+
+        (sqlite3.Cursor, str) -> GBIFFilter
+        """
+        cursor.execute("""SELECT * FROM gbif_filters
+                          WHERE filter_id = ?;""", (filter_id,))
+        columns = [x[0] for x in cursor.description]
+        return cls(dict(zip(columns, cursor.fetchone())))
+
+    def rejected_by(self, occdict):
+        """
+        Returns the name of the first criterion that the record fails, or None
+        if the record passes them all.
+
+        (dict) -> str or None
+        """
+        uncertainty = occdict.get('coordinateUncertaintyInMeters')
+        if uncertainty is None:
+            if self.require_uncertainty:
+                return 'has_coordinate_uncertainty'
+        elif (self.max_uncertainty is not None and
+              uncertainty > self.max_uncertainty):
+            return 'max_coordinate_uncertainty'
+        if occdict.get('collectionCode') in self.collections:
+            return 'collection_codes_omit'
+        if occdict.get('institutionCode') in self.institutions:
+            return 'institutions_omit'
+        if occdict.get('basisOfRecord') in self.bases:
+            return 'bases_omit'
+        if occdict.get('protocol') in self.protocols:
+            return 'protocols_omit'
+        if not self.issues.isdisjoint(occdict.get('issues', [])):
+            return 'issues_omit'
+        if occdict.get('samplingProtocol') in self.sampling:
+            return 'sampling_protocols_omit'
+        return None
+
+    def __call__(self, occdict):
+        """
+        Tests a record and tallies the outcome.  Returns True if the record
+        should be kept.
+
+        (dict) -> bool
+        """
+        reason = self.rejected_by(occdict)
+        if reason is None:
+            self.kept += 1
+            return True
+        self.dropped[reason] += 1
+        return False
+
+    def filter(self, occdicts):
+        """
+        Yields the records from an iterable that pass the filter.
+
+        (iterable of dicts) -> generator of dicts
+        """
+        for occdict in occdicts:
+            if self(occdict):
+                yield occdict
+
+    def report(self):
+        """
+        Returns the kept and dropped counts as a pandas data frame with
+        columns 'criterion' and 'dropped', including a final 'kept' row.
+        """
+        import pandas as pd
+        rows = [(x, self.dropped[x]) for x in self.criteria]
+        rows.append(('kept', self.kept))
+        return pd.DataFrame(rows, columns=['criterion', 'dropped'])
+
+def project_GBIF_record(occdict, keykeys):
+    """
+    Pulls the attributes in keykeys out of a GBIF occurrence dictionary and
+    adds the combined 'remarks' field.  'dataGeneralizations' is set to an
+    empty string when GBIF didn't return it.
+
+    (dict, list) -> dict
+    """
+    x = dict((y, occdict[y]) for y in keykeys if y in occdict)
+    remarks = [x[y] for y in ('locality', 'eventRemarks', 'locationRemarks',
+                              'occurrenceRemarks') if type(x.get(y)) == str]
+    x['remarks'] = "; ".join(remarks)
+    if 'dataGeneralizations' not in x:
+        x['dataGeneralizations'] = ""
+    return x
+
+def filter_GBIF_pages(pages, keykeys, occ_filter):
+    """
+    Generator stage that projects and filters pages of GBIF records as they
+    arrive.  Nothing is accumulated between pages, so a consumer that inserts
+    each page before asking for the next holds at most a few pages in memory.
+
+    (iterable of (int, list), list, GBIFFilter) ->
+        generator of (offset, raw records, kept records)
+
+    Arguments:
+    pages -- (offset, records) pairs, e.g. from get_GBIF_pages.
+    keykeys -- attributes to keep from each record; see project_GBIF_record.
+    occ_filter -- GBIFFilter to apply to the projected records.
+    """
+    for offset, occs in pages:
+        kept = list(occ_filter.filter(project_GBIF_record(x, keykeys)
+                                      for x in occs))
+        yield offset, occs, kept
+
+class OccurrenceLoader(object):
+    """
+    Bulk loader for the occurrences table of an occurrence database.  Records
+    are converted to parameter tuples in Python and written with a single
+    executemany per batch inside one transaction, with the point geometry
+    built by MakePoint and individualCount written in the same insert.
+    Running totals are kept so the load rate can be reported at the end.
+
+    Arguments:
+    conn -- sqlite3 connection to the occurrence database, with mod_spatialite
+            loaded.
+    sp_id -- species id for this project.
+    request_id -- gbif_requests id the records came from.
+    filter_id -- gbif_filters id the records passed.
+    default_uncertainty -- coordinate uncertainty (m) to use for records
+                           without a positive coordinateUncertaintyInMeters.
+    SRID_dict -- dictionary of geodetic datum names to SRIDs.
+    """
+    sql = """INSERT OR IGNORE INTO occurrences (occ_id, species_id, source,
+                                               coordinateUncertaintyInMeters,
+                                               occurrenceDate, request_id,
+                                               filter_id, generalizations,
+                                               remarks, individualCount,
+                                               geom_xy4326)
+             VALUES (?, ?, 'gbif', ?, ?, ?, ?, ?, ?, ?, MakePoint(?, ?, ?));"""
+
+    def __init__(self, conn, sp_id, request_id, filter_id, default_uncertainty,
+                 SRID_dict):
+        self.conn = conn
+        self.sp_id = sp_id
+        self.request_id = request_id
+        self.filter_id = filter_id
+        self.default_uncertainty = default_uncertainty
+        self.SRID_dict = SRID_dict
+        self.rows = 0
+        self.skipped = 0
+        self.seconds = 0.
+
+    def make_row(self, x):
+        """
+        Converts a projected GBIF record into a parameter tuple for the insert
+        statement.
+
+        (dict) -> tuple
+        """
+        uncertainty = x.get('coordinateUncertaintyInMeters')
+        if uncertainty is None or uncertainty <= 0:
+            uncertainty = self.default_uncertainty
+        count = x.get('individualCount')
+        if count is None:
+            count = 1
+        return (x['gbifID'], self.sp_id, uncertainty, x['eventDate'],
+                self.request_id, self.filter_id, x['dataGeneralizations'],
+                x['remarks'], count, x['decimalLongitude'],
+                x['decimalLatitude'], self.SRID_dict[x['geodeticDatum']])
+
+    def load(self, occs):
+        """
+        Inserts a batch of records in a single transaction.  Records that
+        can't be converted are reported and skipped; records whose occ_id is
+        already in the table are ignored.  Returns the number of rows added.
+
+        (list of dicts) -> int
+        """
+        import time
+
+        start = time.time()
+        params = []
+        for x in occs:
+            try:
+                params.append(self.make_row(x))
+            except Exception as e:
+                self.skipped += 1
+                print("\nThere was a problem with the following record:")
+                print(repr(e))
+                print(x)
+        before = self.conn.total_changes
+        with self.conn:
+            self.conn.executemany(self.sql, params)
+        added = self.conn.total_changes - before
+        self.skipped += len(params) - added
+        self.rows += added
+        self.seconds += time.time() - start
+        return added
+
+    def rate(self):
+        """
+        Returns rows loaded per second so far.
+
+        () -> float
+        """
+        if self.seconds == 0:
+            return 0.
+        return self.rows / self.seconds
+
+def GBIF_download_queries(gbif_id, search_params):
+    """
+    Translates occurrences.search parameters into the query strings used by
+    pygbif's occurrences.download, so that a download returns the same records
+    as the search.  Range values ('min,max') become a pair of >= and <=
+    predicates.
+
+    (str, dict) -> list of str
+    """
+    queries = ['taxonKey = {0}'.format(gbif_id)]
+    for name, value in sorted(search_params.items()):
+        if value is None:
+            continue
+        value = str(value)
+        if ',' in value:
+            low, high = [x.strip() for x in value.split(',')]
+            queries.append('{0} >= {1}'.format(name, low))
+            queries.append('{0} <= {1}'.format(name, high))
+        elif value in ('True', 'False'):
+            queries.append('{0} = {1}'.format(name, value.upper()))
+        elif name == 'continent':
+            queries.append('{0} = {1}'.format(name, value.upper()))
+        else:
+            queries.append('{0} = {1}'.format(name, value))
+    return queries
+
+def request_GBIF_download(gbif_id, search_params):
+    """
+    Requests a Darwin Core Archive of the records matching a search from the
+    GBIF occurrence download API and returns the download key.  Save the key
+    before waiting on the download (download_GBIF_archive), so an
+    interrupted run can pick up the same download rather than request
+    another.
+
+    GBIF credentials are read by pygbif from the GBIF_USER, GBIF_PWD and
+    GBIF_EMAIL environment variables.
+
+    (str, dict) -> str
+
+    Arguments:
+    gbif_id -- GBIF taxon key of the species.
+    search_params -- dictionary of occurrences.search keyword arguments; see
+                     GBIF_download_queries.
+    """
+    from pygbif import occurrences
+
+    queries = GBIF_download_queries(gbif_id, search_params)
+    # Requesting a download starts a job on GBIF's side, so don't retry it
+    key = request_governor.call('api.gbif.org', occurrences.download, queries,
+                                format='DWCA', retry=False)[0]
+    print('GBIF download {0} requested'.format(key))
+    return key
+
+def download_GBIF_archive(key, toDir, poll_seconds=60, timeout_hours=12):
+    """
+    Waits for GBIF to prepare a download from request_GBIF_download and
+    saves the zip in toDir.  Returns the path to the zip.  Use a download
+    instead of paging when a search returns more records than the search API
+    can page through.
+
+    (str, str, int, int) -> str
+
+    Arguments:
+    key -- GBIF download key.
+    toDir -- directory to save the archive in.
+    poll_seconds -- how often to check whether the download is ready.
+    timeout_hours -- how long to wait before giving up.
+    """
+    from pygbif import occurrences
+    import time
+
+    gbif = 'api.gbif.org'
+    waited = 0
+    while True:
+        status = request_governor.call(gbif, occurrences.download_meta,
+                                       key)['status']
+        if status == 'SUCCEEDED':
+            break
+        if status in ('FAILED', 'KILLED', 'CANCELLED'):
+            raise Exception('GBIF download {0} ended with status {1}'.format(
+                            key, status))
+        if waited > timeout_hours * 3600:
+            raise Exception('GBIF download {0} not ready after {1} hours'.format(
+                            key, timeout_hours))
+        time.sleep(poll_seconds)
+        waited += poll_seconds
+
+    return request_governor.call(gbif, occurrences.download_get, key,
+                                 path=toDir)['path']
+
+# Darwin Core Archive columns that need converting to match search results
+DwCA_types = {'decimalLatitude': float, 'decimalLongitude': float,
+              'coordinateUncertaintyInMeters': float, 'individualCount': int,
+              'year': int, 'month': int, 'day': int}
+
+def read_DwCA_pages(archive, page_size=300, skip=()):
+    """
+    Reads the occurrence core of a Darwin Core Archive zip row by row,
+    without extracting it, and yields the records in pages shaped like
+    occurrences.search results so that they can go through the same
+    filter/insert steps.  Empty fields are left out of the record, numeric
+    fields are converted, and the semicolon separated 'issue' column becomes
+    the 'issues' list.
+
+    (str or file object, int) -> generator of (offset, list of dicts)
+
+    Arguments:
+    archive -- path to, or open binary file object of, the archive zip.
+    page_size -- number of records per page.
+    skip -- offsets of pages not to yield.  The rows are still read, since
+            the archive can only be read in order.
+    """
+    import zipfile
+    import io
+    import csv
+    import xml.etree.ElementTree as ET
+
+    with zipfile.ZipFile(archive) as zf:
+        # The core file's name, layout, and columns are described in meta.xml
+        meta = ET.fromstring(zf.read('meta.xml'))
+        core = [x for x in meta if x.tag.endswith('core')][0]
+        location = [x for x in core.iter() if x.tag.endswith('location')][0]
+        delimiter = core.get('fieldsTerminatedBy', '\\t')
+        delimiter = delimiter.replace('\\t', '\t').replace('\\n', '\n')
+        header_lines = int(core.get('ignoreHeaderLines', '0'))
+        columns = {}
+        for field in core:
+            if field.tag.endswith('id'):
+                columns[int(field.get('index'))] = 'gbifID'
+            elif field.tag.endswith('field') and field.get('index') is not None:
+                columns[int(field.get('index'))] = field.get('term').split('/')[-1]
+
+        with zf.open(location.text) as raw:
+            text = io.TextIOWrapper(raw, encoding=core.get('encoding', 'utf-8'))
+            reader = csv.reader(text, delimiter=delimiter,
+                                quoting=csv.QUOTE_NONE)
+            for i in range(header_lines):
+                next(reader, None)
+
+            skip = set(skip)
+            offset = 0
+            page = []
+            for row in reader:
+                if offset in skip:
+                    page.append(None)
+                    if len(page) == page_size:
+                        offset += len(page)
+                        page = []
+                    continue
+                record = {}
+                for index, value in enumerate(row):
+                    name = columns.get(index)
+                    if name is None or value == '':
+                        continue
+                    if name in DwCA_types:
+                        try:
+                            value = DwCA_types[name](float(value))
+                        except ValueError:
+                            continue
+                    record[name] = value
+                record['issues'] = [x for x in record.pop('issue', '').split(';')
+                                    if x != '']
+                page.append(record)
+                if len(page) == page_size:
+                    yield offset, page
+                    offset += len(page)
+                    page = []
+            if page and offset not in skip:
+                yield offset, page
+
+# Parameters that plan_GBIF_partitions can split, and the smallest span to
+# split them down to.
+GBIF_partition_spans = {'year': 1, 'decimalLatitude': 0.1,
+                        'decimalLongitude': 0.1}
+
+def split_GBIF_params(search_params):
+    """
+    Splits a set of occurrences.search parameters in two along the range
+    parameter (year, decimalLatitude, or decimalLongitude) with the widest
+    span relative to its minimum in GBIF_partition_spans.  Year ranges are
+    split into non-overlapping halves; coordinate ranges share their middle
+    value, since GBIF ranges include both ends.  Returns None if nothing can
+    be split further.
+
+    (dict) -> (dict, dict) or None
+    """
+    best = None
+    for name, min_span in GBIF_partition_spans.items():
+        value = search_params.get(name)
+        if value is None or ',' not in str(value):
+            continue
+        low, high = [float(x) for x in str(value).split(',')]
+        if high - low < 2 * min_span:
+            continue
+        if best is None or (high - low) / min_span > best[0]:
+            best = ((high - low) / min_span, name, low, high)
+    if best is None:
+        return None
+
+    name, low, high = best[1:]
+    if name == 'year':
+        low, high = int(low), int(high)
+        middle = (low + high) // 2
+        ranges = ('{0},{1}'.format(low, middle),
+                  '{0},{1}'.format(middle + 1, high))
+    else:
+        middle = round((low + high) / 2., 6)
+        ranges = ('{0},{1}'.format(low, middle),
+                  '{0},{1}'.format(middle, high))
+    return tuple(dict(search_params, **{name: x}) for x in ranges)
+
+def plan_GBIF_partitions(gbif_id, search_params, max_records, cache=None,
+                         workers=None):
+    """
+    Probes record counts and recursively splits a request's year and
+    latitude/longitude ranges until each partition matches no more than
+    max_records records (or can't be split further).  Partitions without
+    records are dropped.  Counts for each level of splitting are probed
+    concurrently.
+
+    (str, dict, int, GBIFCache, int) -> list of (dict, int)
+
+    Arguments:
+    gbif_id -- GBIF taxon key of the species.
+    search_params -- dictionary of keyword arguments for occurrences.search.
+    max_records -- target maximum number of records per partition.
+    cache -- optional GBIFCache for the count probes.
+    workers -- number of count probe threads.  Defaults to the request
+               governor's maximum concurrency, which gates the probes.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+
+    def count(params):
+        return search_GBIF(gbif_id, params, cache=cache, limit=0)['count']
+
+    workers = max(1, workers or request_governor.max_concurrency)
+    partitions = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        level = [search_params]
+        while level:
+            counts = list(pool.map(count, level))
+            next_level = []
+            for params, n in zip(level, counts):
+                if n == 0:
+                    continue
+                halves = None
+                if n > max_records:
+                    halves = split_GBIF_params(params)
+                if halves is None:
+                    partitions.append((params, n))
+                else:
+                    next_level.extend(halves)
+            level = next_level
+    return partitions
+
+def get_GBIF_partitions(gbif_id, partitions, page_size=300, workers=None,
+                        cache=None, skip=(), seen=()):
+    """
+    Retrieves the records for a list of partitions from plan_GBIF_partitions.
+    Up to 'workers' partitions are paged through at once, each on its own
+    thread, and their pages are merged as they arrive.  Records already
+    returned by another partition (same gbifID, e.g. on a shared coordinate
+    boundary) are dropped.  A few pages per worker are buffered, so memory
+    doesn't grow with the number of records.
+
+    A (partition index, None) pair with an empty page is yielded when a
+    partition has been completely retrieved, so callers can record progress.
+
+    (str, list, int, int, GBIFCache, iterable) ->
+        generator of ((partition index, offset), list of dicts)
+
+    Arguments:
+    gbif_id -- GBIF taxon key of the species.
+    partitions -- list of (search parameters, count) pairs.
+    page_size -- number of records per request.
+    workers -- number of partition threads.  Defaults to the request
+               governor's maximum concurrency, which gates the requests.
+    cache -- optional GBIFCache.
+    skip -- (partition index, offset) keys of pages that don't need to be
+            retrieved.
+    seen -- gbifIDs (as strings) already returned, e.g. by an interrupted run
+            being resumed; records with these ids are dropped.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import queue
+    import threading
+
+    workers = max(1, workers or request_governor.max_concurrency)
+    pages = queue.Queue(maxsize=2 * workers)
+    stop = threading.Event()
+    done = object()
+
+    def put(item):
+        # Give up if the consumer has stopped reading pages
+        while not stop.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def get_partition(index):
+        params, count = partitions[index]
+        try:
+            for offset in range(0, count, page_size):
+                if stop.is_set():
+                    return
+                if (index, offset) in skip:
+                    continue
+                occ_json = search_GBIF(gbif_id, params, cache=cache,
+                                       limit=page_size, offset=offset)
+                put(((index, offset), occ_json['results']))
+            put(((index, None), []))
+        finally:
+            put(done)
+
+    skip = set(tuple(x) for x in skip)
+    todo = [i for i in range(len(partitions)) if (i, None) not in skip]
+    seen = set(str(x) for x in seen)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(get_partition, i) for i in todo]
+        remaining = len(futures)
+        try:
+            while remaining:
+                item = pages.get()
+                if item is done:
+                    remaining -= 1
+                    continue
+                key, occs = item
+                new = []
+                for x in occs:
+                    gbif_key = str(x.get('gbifID'))
+                    if gbif_key not in seen:
+                        seen.add(gbif_key)
+                        new.append(x)
+                yield key, new
+        finally:
+            stop.set()
+        # Surface any request errors from the worker threads
+        for future in futures:
+            future.result()
+
+def retrieval_fingerprint(cursor, sp_id, request_id, filter_id, page_size):
+    """
+    Returns a fingerprint of everything that determines which records a
+    retrieval run inserts: the species, the gbif_requests and gbif_filters
+    rows in the parameters database, and the page size.  A run can only be
+    resumed by a run with the same fingerprint.
+
+    (sqlite3.Cursor, str, str, str, int) -> str
+    """
+    import hashlib
+    import json
+
+    rows = {}
+    for table, column, value in (('species_concepts', 'species_id', sp_id),
+                                 ('gbif_requests', 'request_id', request_id),
+                                 ('gbif_filters', 'filter_id', filter_id)):
+        cursor.execute("SELECT * FROM {0} WHERE {1} = ?;".format(table, column),
+                       (value,))
+        columns = [x[0] for x in cursor.description]
+        rows[table] = dict(zip(columns, cursor.fetchone() or ()))
+    rows['page_size'] = page_size
+    text = json.dumps(rows, sort_keys=True, default=str)
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def save_checkpoint(conn, fingerprint, unit, state=None, records=()):
+    """
+    Records that a unit of retrieval work (a page, a partition page, or the
+    retrieval plan) has been completed and inserted, along with the state
+    needed to continue from there.  Only the latest state is kept.  The unit
+    'complete' marks a finished run.
+
+    records are the gbifIDs of the unit's records, for retrievals that need
+    to recognize records they've already seen when resuming (see
+    get_GBIF_partitions).
+
+    (sqlite3.Connection, str, json-able, dict, iterable) -> None
+    """
+    import json
+
+    with conn:
+        conn.executescript("""
+            CREATE TABLE IF NOT EXISTS retrieval_checkpoints (
+                unit TEXT NOT NULL PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                saved TEXT DEFAULT CURRENT_TIMESTAMP);
+
+            CREATE TABLE IF NOT EXISTS retrieval_state (
+                fingerprint TEXT NOT NULL PRIMARY KEY,
+                state TEXT,
+                saved TEXT DEFAULT CURRENT_TIMESTAMP);
+
+            CREATE TABLE IF NOT EXISTS retrieval_records (
+                gbifID TEXT NOT NULL PRIMARY KEY);
+            """)
+        conn.execute("""INSERT OR REPLACE INTO retrieval_checkpoints
+                        (unit, fingerprint) VALUES (?, ?);""",
+                     (json.dumps(unit), fingerprint))
+        if state is not None:
+            conn.execute("""INSERT OR REPLACE INTO retrieval_state
+                            (fingerprint, state) VALUES (?, ?);""",
+                         (fingerprint, json.dumps(state)))
+        conn.executemany("INSERT OR IGNORE INTO retrieval_records VALUES (?);",
+                         [(str(x),) for x in records if x is not None])
+
+def load_checkpoints(db, fingerprint):
+    """
+    Reads the checkpoints of an unfinished retrieval run from an occurrence
+    database.  Returns None if there is nothing to resume: the database
+    doesn't exist, has no checkpoints, was made with a different fingerprint,
+    or the run finished.  Otherwise returns the set of completed units (lists
+    converted to tuples), the most recently saved state, and the set of
+    gbifIDs saved with save_checkpoint's records.
+
+    (str, str) -> (set, dict, set) or None
+    """
+    import json
+    import os
+    import sqlite3
+
+    if not os.path.exists(db):
+        return None
+    conn = sqlite3.connect(db)
+    try:
+        rows = conn.execute("""SELECT unit, fingerprint
+                               FROM retrieval_checkpoints
+                               ORDER BY rowid;""").fetchall()
+        saved = conn.execute("""SELECT state FROM retrieval_state
+                                WHERE fingerprint = ?;""",
+                             (fingerprint,)).fetchone()
+        records = set(x[0] for x in
+                      conn.execute("SELECT gbifID FROM retrieval_records;"))
+    except sqlite3.OperationalError:
+        rows = []
+    finally:
+        conn.close()
+
+    units = set()
+    for unit, print_ in rows:
+        if print_ != fingerprint:
+            return None
+        unit = json.loads(unit)
+        if unit == 'complete':
+            return None
+        units.add(tuple(unit) if type(unit) == list else unit)
+    if not units:
+        return None
+    state = None
+    if saved is not None and saved[0] is not None:
+        state = json.loads(saved[0])
+    return units, state, records
+
+class RecordSummary(object):
+    """
+    Streaming summary of GBIF occurrence records for one step of retrieval
+    ('request' for records as returned, 'filter' for records kept).  Records
+    are fed in pages with add(), and everything is tallied in a single pass
+    with Counters:  how often each field was included and populated, and
+    value counts for datums, issues, bases of record, institutions,
+    collections, protocols, sampling protocols, establishment means and
+    identification qualifiers.
+
+    Arguments:
+    step -- name of the step, used in the record_attributes table.
+    """
+    # Fields reported in record_attributes and the counters behind them.
+    # 'generalizations' and 'remarks' are reported but not tallied.
+    attribute_fields = (('datums', ('datums',)), ('issues', ('issues',)),
+                        ('bases', ('bases',)),
+                        ('institutions', ('institutions',)),
+                        ('collections', ('collections',)),
+                        ('generalizations', ()), ('remarks', ()),
+                        ('establishment', ('establishment',)),
+                        ('IDqualifier', ('IDqualifier',)),
+                        ('protocols', ('protocols', 'samplingProtocols')))
+    # Counters reported in post_request_value_counts
+    value_fields = ('bases', 'datums', 'issues', 'institutions', 'collections',
+                    'protocols', 'samplingProtocols')
+    counters = ('datums', 'issues', 'bases', 'institutions', 'collections',
+                'establishment', 'IDqualifier', 'protocols',
+                'samplingProtocols')
+
+    def __init__(self, step):
+        from collections import Counter
+
+        self.step = step
+        self.included = Counter()
+        self.populated = Counter()
+        self.values = dict((x, Counter()) for x in self.counters)
+
+    def add(self, occs):
+        """
+        Tallies a page of records.
+
+        (iterable of dicts) -> None
+        """
+        included = self.included
+        populated = self.populated
+        values = self.values
+        for occdict in occs:
+            for field, value in occdict.items():
+                included[field] += 1
+                if value is not None and (not hasattr(value, '__len__') or
+                                          len(value) > 0):
+                    populated[field] += 1
+
+            values['datums'][occdict.get('geodeticDatum') or 'UNKNOWN'] += 1
+            values['issues'].update(occdict.get('issues') or [])
+            values['bases'][occdict.get('basisOfRecord') or 'UNKNOWN'] += 1
+            values['institutions'][occdict.get('institutionID') or
+                                   occdict.get('institutionCode') or
+                                   'UNKNOWN'] += 1
+            values['collections'][occdict.get('collectionCode') or
+                                  'UNKNOWN'] += 1
+            values['protocols'][occdict.get('protocol') or 'UNKNOWN'] += 1
+            values['samplingProtocols'][occdict.get('samplingProtocol') or
+                                        'UNKNOWN'] += 1
+            if 'establishmentMeans' in occdict:
+                values['establishment'][occdict['establishmentMeans']] += 1
+            if 'identificationQualifier' in occdict:
+                values['IDqualifier'][occdict['identificationQualifier']] += 1
+
+    def fields_returned(self):
+        """
+        Returns a data frame of how many records included and populated each
+        field, indexed by field name (the gbif_fields_returned table).
+        """
+        import pandas as pd
+
+        fields = sorted(self.included)
+        return pd.DataFrame({'included(n)': [self.included[x] for x in fields],
+                             'populated(n)': [self.populated[x] for x in fields]},
+                            index=fields)
+
+    def attributes(self):
+        """
+        Returns (step, field, vals) rows for the record_attributes table,
+        where vals lists the distinct values seen.
+
+        () -> list of tuples
+        """
+        rows = []
+        for field, counters in self.attribute_fields:
+            vals = set()
+            for x in counters:
+                vals.update(self.values[x])
+            vals = str(sorted(vals, key=str)).replace('"', '')
+            rows.append((self.step, field, vals))
+        return rows
+
+    def value_counts(self):
+        """
+        Returns (attribute, value, count) rows for the
+        post_request_value_counts table.
+
+        () -> list of tuples
+        """
+        return [(x, str(value), count) for x in self.value_fields
+                for value, count in sorted(self.values[x].items(),
+                                           key=lambda y: str(y[0]))]
+
+    def state(self):
+        """
+        Returns the tallies as a json-able dictionary, for checkpoints.
+        """
+        state = {'included': list(self.included.items()),
+                 'populated': list(self.populated.items())}
+        for x in self.counters:
+            state[x] = list(self.values[x].items())
+        return state
+
+    def restore(self, state):
+        """
+        Adds tallies saved with state() back in, e.g. when resuming a run.
+        """
+        self.included.update(dict(state['included']))
+        self.populated.update(dict(state['populated']))
+        for x in self.counters:
+            self.values[x].update(dict(state[x]))
+
+def process_pool(workers, **kwargs):
+    """
+    Returns a ProcessPoolExecutor that starts its workers the platform's
+    default way ('spawn' on macOS, where forking a process that has started
+    threads or system frameworks can crash or deadlock).  Spawned workers
+    import the main script, so the scripts in this repo keep their work under
+    "if __name__ == '__main__':".
+
+    (int, ...) -> concurrent.futures.ProcessPoolExecutor
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=workers, **kwargs)
+
+# North America Albers Equal Area Conic, as registered as SRID 102008 in the
+# occurrence and range evaluation databases.
+albers_proj4 = ('+proj=aea +lat_1=20 +lat_2=60 +lat_0=40 +lon_0=-96 +x_0=0 '
+                '+y_0=0 +datum=NAD83 +units=m +no_defs')
+
+# SQL that registers SRID 102008 in a SpatiaLite database's spatial_ref_sys.
+sql_albers_srid = """INSERT into spatial_ref_sys
+             (srid, auth_name, auth_srid, proj4text, srtext)
+             values (102008, 'ESRI', 102008, '+proj=aea +lat_1=20 +lat_2=60
+             +lat_0=40 +lon_0=-96 +x_0=0 +y_0=0 +datum=NAD83 +units=m
+             +no_defs ', 'PROJCS["North_America_Albers_Equal_Area_Conic",
+             GEOGCS["GCS_North_American_1983",
+             DATUM["North_American_Datum_1983",
+             SPHEROID["GRS_1980",6378137,298.257222101]],
+             PRIMEM["Greenwich",0],UNIT["Degree",0.017453292519943295]],
+             PROJECTION["Albers_Conic_Equal_Area"],
+             PARAMETER["False_Easting",0],
+             PARAMETER["False_Northing",0],
+             PARAMETER["longitude_of_center",-96],
+             PARAMETER["Standard_Parallel_1",20],
+             PARAMETER["Standard_Parallel_2",60],
+             PARAMETER["latitude_of_center",40],
+             UNIT["Meter",1],AUTHORITY["EPSG","102008"]]');"""
+
+def polygon_WKB(rings):
+    """
+    Packs an array of closed rings, shape (n, points, 2), into a list of n
+    little-endian WKB polygons.
+
+    (numpy array) -> list of bytes
+    """
+    import struct
+    import numpy as np
+
+    header = struct.pack('<BIII', 1, 3, 1, rings.shape[1])
+    body = np.ascontiguousarray(rings, dtype='<f8')
+    return [header + x.tobytes() for x in body]
+
+def buffer_chunk(lons, lats, radii, segments=64):
+    """
+    Buffers a chunk of WGS84 points by radii given in meters.  Points are
+    projected to Albers (SRID 102008) as whole arrays, circles are built with
+    'segments' vertices, and the circle vertices are projected back to WGS84
+    in one call.  Returns WKB polygons in both systems.
+
+    (array, array, array, int) -> (list of bytes, list of bytes)
+
+    Arguments:
+    lons, lats -- WGS84 coordinates of the points.
+    radii -- buffer radius for each point, in meters.
+    segments -- number of vertices around each circle.
+    """
+    import numpy as np
+    from pyproj import Transformer
+
+    to_albers = Transformer.from_crs('EPSG:4326', albers_proj4, always_xy=True)
+    to_wgs84 = Transformer.from_crs(albers_proj4, 'EPSG:4326', always_xy=True)
+
+    x, y = to_albers.transform(np.asarray(lons, dtype=float),
+                               np.asarray(lats, dtype=float))
+    radii = np.asarray(radii, dtype=float)[:, None]
+
+    # Angles run counterclockwise; the first vertex is repeated to close
+    angles = np.linspace(0, 2 * np.pi, segments + 1)
+    angles[-1] = 0
+    cx = x[:, None] + radii * np.cos(angles)
+    cy = y[:, None] + radii * np.sin(angles)
+    albers = np.stack([cx, cy], axis=-1)
+
+    lon, lat = to_wgs84.transform(cx.ravel(), cy.ravel())
+    wgs84 = np.stack([lon, lat], axis=-1).reshape(albers.shape)
+    return polygon_WKB(albers), polygon_WKB(wgs84)
+
+def buffer_occurrences(conn, segments=64, chunk_size=50000, workers=1):
+    """
+    Fills the circle_albers (SRID 102008) and circle_wgs84 (SRID 4326)
+    polygon columns of an occurrence database's occurrences table by
+    buffering geom_xy4326 by radius_meters.  The geometry is built with
+    numpy/pyproj outside of SpatiaLite (see buffer_chunk) and written back
+    as WKB, a chunk at a time, with executemany.  With workers > 1, chunks are
+    buffered in a process pool while earlier chunks are written.
+
+    (sqlite3.Connection, int, int, int) -> int, number of circles written
+
+    Arguments:
+    conn -- connection to the occurrence database, with mod_spatialite loaded.
+    segments -- number of vertices around each circle.
+    chunk_size -- number of occurrences per chunk.
+    workers -- number of processes to buffer chunks with.
+    """
+    columns = [x[1] for x in conn.execute("PRAGMA table_info(occurrences);")]
+    for column in ('circle_albers', 'circle_wgs84'):
+        if column not in columns:
+            conn.execute("ALTER TABLE occurrences ADD COLUMN {0} BLOB;".format(
+                         column))
+
+    def chunks():
+        # Each chunk is its own query on the next range of occ_ids (the
+        # rowid), so no SELECT cursor is open while rows are updated and only
+        # the chunks in flight are held in memory.
+        last = None
+        while True:
+            chunk = conn.execute("""SELECT occ_id, X(geom_xy4326),
+                                           Y(geom_xy4326), radius_meters
+                                    FROM occurrences
+                                    WHERE geom_xy4326 IS NOT NULL
+                                      AND radius_meters IS NOT NULL
+                                      AND (? IS NULL OR occ_id > ?)
+                                    ORDER BY occ_id
+                                    LIMIT ?;""",
+                                 (last, last, chunk_size)).fetchall()
+            if not chunk:
+                return
+            ids, lons, lats, radii = zip(*chunk)
+            last = ids[-1]
+            yield ids, (lons, lats, radii, segments)
+
+    written = [0]
+
+    def write(ids, circles):
+        written[0] += len(ids)
+        with conn:
+            conn.executemany("""UPDATE occurrences
+                                SET circle_albers = GeomFromWKB(?, 102008),
+                                    circle_wgs84 = GeomFromWKB(?, 4326)
+                                WHERE occ_id = ?;""",
+                             zip(circles[0], circles[1], ids))
+
+    if workers > 1:
+        from collections import deque
+
+        # Keep a couple of chunks per process queued, not the whole table
+        with process_pool(workers) as pool:
+            pending = deque()
+            for ids, args in chunks():
+                pending.append((ids, pool.submit(buffer_chunk, *args)))
+                if len(pending) >= 2 * workers:
+                    ids, future = pending.popleft()
+                    write(ids, future.result())
+            while pending:
+                ids, future = pending.popleft()
+                write(ids, future.result())
+    else:
+        for ids, args in chunks():
+            write(ids, buffer_chunk(*args))
+
+    conn.executescript("""
+        SELECT RecoverGeometryColumn('occurrences', 'circle_albers', 102008,
+                                     'POLYGON', 'XY');
+
+        SELECT RecoverGeometryColumn('occurrences', 'circle_wgs84', 4326,
+                                     'POLYGON', 'XY');""")
+    return written[0]
+
+# HUC polygons and their STRtree, loaded once per process by load_huc_tree.
+huc_tree_cache = {}
+
+def load_huc_tree(huc_ids, huc_wkbs=None, huc_store=None):
+    """
+    Loads HUC polygons and builds an STRtree over them, keeping both in
+    huc_tree_cache for proportion_chunk.  The polygons and their boundaries
+    are prepared for repeated point-in-polygon and distance tests.  Used as
+    the initializer of the worker processes in circle_proportions.
+
+    The polygons come either from WKB or, when huc_store is given, from the
+    memory-mapped store written by build_huc_store, in which case huc_ids are
+    indexes into the store and nothing is parsed.
+
+    (list, list of bytes, str) -> None
+    """
+    import shapely
+    from shapely.strtree import STRtree
+
+    if huc_store is None:
+        geoms = shapely.from_wkb([bytes(x) for x in huc_wkbs])
+    else:
+        huc_ids, geoms = huc_store_geometries(open_huc_store(huc_store),
+                                              huc_ids)
+        huc_ids = huc_ids.tolist()
+    boundaries = shapely.boundary(geoms)
+    shapely.prepare(geoms)
+    huc_tree_cache['ids'] = list(huc_ids)
+    huc_tree_cache['geoms'] = geoms
+    huc_tree_cache['boundaries'] = boundaries
+    huc_tree_cache['tree'] = STRtree(geoms)
+
+def proportion_chunk(circles):
+    """
+    For a chunk of (occ_id, circle WKB) pairs, finds the HUCs each circle
+    intersects (with the STRtree from load_huc_tree) and the percent of the
+    circle's area that falls within each.
+
+    Candidate HUCs come from the tree's bounding boxes.  Most pairs are
+    settled without building an intersection polygon:
+    contained -- the circle's center is in the HUC and the HUC's boundary is
+                 at least a radius away, so the circle is 100% inside.
+    excluded -- the center is outside the HUC and the HUC is at least a
+                radius away, so only the bounding boxes overlap.
+    exact -- anything else straddles the boundary and is intersected.
+    The radius is the distance from the centroid to the farthest vertex, so
+    the circle polygon always lies within it.
+
+    (list of (int, bytes)) ->
+        (list of (HUC id, occ_id, percent), dict of path counts)
+    """
+    import shapely
+
+    ids = huc_tree_cache['ids']
+    geoms = huc_tree_cache['geoms']
+    boundaries = huc_tree_cache['boundaries']
+    tree = huc_tree_cache['tree']
+    counts = {'contained': 0, 'excluded': 0, 'exact': 0}
+    results = []
+    for occ_id, circle_wkb in circles:
+        circle = shapely.from_wkb(bytes(circle_wkb))
+        area = circle.area
+        if area == 0:
+            continue
+        center = circle.centroid
+        vertices = shapely.get_coordinates(circle.exterior)
+        radius = ((vertices - (center.x, center.y)) ** 2).sum(axis=1).max() ** .5
+
+        candidates = tree.query(circle)
+        if len(candidates) == 0:
+            continue
+        inside = shapely.contains_xy(geoms[candidates], center.x, center.y)
+        clearance = shapely.distance(boundaries[candidates], center)
+        for i, is_inside, distance in zip(candidates, inside, clearance):
+            if distance >= radius:
+                if is_inside:
+                    counts['contained'] += 1
+                    results.append((ids[i], occ_id, 100.))
+                else:
+                    counts['excluded'] += 1
+                continue
+            counts['exact'] += 1
+            overlap = geoms[i].intersection(circle).area
+            if overlap > 0:
+                results.append((ids[i], occ_id, 100. * overlap / area))
+    return results, counts
+
+def circle_proportions(hucs, circles, workers=1, chunk_size=2000,
+                       huc_store=None):
+    """
+    Computes proportion_circle, the percent of each occurrence circle's area
+    within each HUC it intersects, for every intersecting (HUC, occurrence)
+    pair.  Circles are split into chunks that are processed in parallel
+    across 'workers' processes, each holding its own STRtree of the HUCs.
+
+    Returns the pairs and a count of how many candidate pairs were settled
+    by each path in proportion_chunk (contained, excluded, exact).
+
+    (list of (str, bytes), list of (int, bytes), int, int, str) ->
+        (list of (HUC id, occ_id, percent), dict)
+
+    Arguments:
+    hucs -- (HUC12RNG, polygon WKB) pairs, or indexes into huc_store.
+    circles -- (occ_id, circle WKB) pairs in the same coordinate system.
+    workers -- number of processes.
+    chunk_size -- circles per chunk.
+    huc_store -- directory of a store from build_huc_store.  Workers
+                 memory-map it rather than being sent the polygons.
+    """
+    if huc_store is None:
+        huc_ids = [x[0] for x in hucs]
+        huc_wkbs = [bytes(x[1]) for x in hucs]
+    else:
+        huc_ids = [int(x) for x in hucs]
+        huc_wkbs = None
+    circles = [(x[0], bytes(x[1])) for x in circles]
+    chunks = [circles[i:i + chunk_size]
+              for i in range(0, len(circles), chunk_size)]
+
+    results = []
+    counts = {'contained': 0, 'excluded': 0, 'exact': 0}
+
+    def collect(chunk_output):
+        results.extend(chunk_output[0])
+        for x in counts:
+            counts[x] += chunk_output[1][x]
+
+    if workers > 1:
+        with process_pool(workers, initializer=load_huc_tree,
+                          initargs=(huc_ids, huc_wkbs,
+                                    huc_store)) as pool:
+            for chunk_output in pool.map(proportion_chunk, chunks):
+                collect(chunk_output)
+    else:
+        load_huc_tree(huc_ids, huc_wkbs, huc_store)
+        for chunk in chunks:
+            collect(proportion_chunk(chunk))
+    return results, counts
+
+def file_hash(paths):
+    """
+    Returns a sha1 hex digest of the contents of a list of files, read in
+    1 MB blocks.  Missing files are skipped.
+
+    (list of str) -> str
+    """
+    import hashlib
+    import os
+
+    digest = hashlib.sha1()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        digest.update(os.path.basename(path).encode('utf-8'))
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+def file_stats(paths):
+    """
+    Returns the names, sizes, and modification times of a list of files as a
+    json string, a cheap stand-in for file_hash when deciding whether files
+    might have changed.  Missing files are skipped.
+
+    (list of str) -> str
+    """
+    import json
+    import os
+
+    stats = []
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        info = os.stat(path)
+        stats.append([os.path.basename(path), info.st_size, info.st_mtime_ns])
+    return json.dumps(stats)
+
+def build_huc_reference_db(shucLoc, huc_db):
+    """
+    Builds the shared, read-only HUC12 reference database that range
+    evaluation databases ATTACH instead of importing the SHUCS shapefile
+    themselves, and that build_huc_store packs the hucs from.  It holds the
+    'shucs' table (SRID 102008), looked up by HUC12RNG; spatial selection is
+    done with the huc store, so geom_102008 isn't spatially indexed.  A hash of the shapefile's contents is stored in
+    the reference_info table, and the database is only rebuilt when the
+    shapefile has changed (or the database doesn't exist).  The shapefile's
+    sizes and modification times are stored too, and it is only re-hashed
+    when they differ.
+
+    (str, str) -> bool, True if the database was (re)built
+
+    Arguments:
+    shucLoc -- path to the SHUCS shapefile, without extension.
+    huc_db -- path of the reference database.
+    """
+    import os
+    import sqlite3
+    import stat
+
+    sources = [shucLoc + x for x in ('.shp', '.shx', '.dbf', '.prj', '.cpg')]
+    source_stats = file_stats(sources)
+    if os.path.exists(huc_db):
+        conn = sqlite3.connect('file:{0}?mode=ro'.format(huc_db), uri=True)
+        try:
+            built_hash, built_stats = conn.execute(
+                """SELECT source_hash, source_stats
+                   FROM reference_info;""").fetchone()
+        except (sqlite3.Error, TypeError):
+            built_hash, built_stats = None, None
+        finally:
+            conn.close()
+        if built_stats == source_stats:
+            return False
+        source_hash = file_hash(sources)
+        if built_hash == source_hash:
+            # Touched but not changed; record the new stats so the shapefile
+            # isn't hashed again next time.
+            mode = os.stat(huc_db).st_mode
+            os.chmod(huc_db, mode | stat.S_IWUSR)
+            try:
+                conn = sqlite3.connect(huc_db)
+                with conn:
+                    conn.execute("UPDATE reference_info SET source_stats = ?;",
+                                 (source_stats,))
+                conn.close()
+            finally:
+                os.chmod(huc_db, mode)
+            return False
+    else:
+        source_hash = file_hash(sources)
+
+    # Build next to the final path and swap it in when it's complete
+    temp_db = huc_db + '.building'
+    if os.path.exists(temp_db):
+        os.remove(temp_db)
+    conn = sqlite3.connect(temp_db)
+    os.putenv('SPATIALITE_SECURITY', 'relaxed')
+    conn.enable_load_extension(True)
+    conn.execute('SELECT load_extension("mod_spatialite")')
+    conn.executescript("""
+        SELECT InitSpatialMetadata(1);
+
+        {0}
+
+        SELECT ImportSHP('{1}', 'shucs', 'utf-8', 102008,
+                         'geom_102008', 'HUC12RNG', 'POLYGON');
+
+        CREATE TABLE reference_info (source TEXT, source_hash TEXT,
+                                     source_stats TEXT,
+                                     built TEXT DEFAULT CURRENT_TIMESTAMP);
+        """.format(sql_albers_srid, shucLoc))
+    conn.execute("""INSERT INTO reference_info
+                    (source, source_hash, source_stats) VALUES (?, ?, ?);""",
+                 (shucLoc, source_hash, source_stats))
+    conn.commit()
+    conn.execute('VACUUM;')
+    conn.close()
+
+    os.chmod(temp_db, stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH)
+    os.replace(temp_db, huc_db)
+    return True
+
+def attach_huc_reference(conn, huc_db):
+    """
+    Attaches the HUC12 reference database (see build_huc_reference_db)
+    read-only as 'hucs', so the hucs are available as hucs.shucs, e.g. for
+    geometry by HUC12RNG.  For spatial selection use the huc store
+    (huc_store_select).  conn must have been opened with uri=True.
+
+    (sqlite3.Connection, str) -> None
+    """
+    conn.execute("ATTACH DATABASE ? AS hucs;",
+                 ('file:{0}?mode=ro'.format(huc_db),))
+
+huc_store_arrays = ('coords', 'ring_offsets', 'part_offsets',
+                    'feature_offsets', 'bboxes', 'ids')
+
+def build_huc_store(huc_db, store_dir):
+    """
+    Packs the hucs from the HUC12 reference database (see
+    build_huc_reference_db) into a directory of .npy arrays that
+    open_huc_store memory-maps, so processes can share the polygons without
+    reading or parsing them:
+    coords -- (n, 2) float64 vertex coordinates (SRID 102008).
+    ring_offsets -- start of each ring in coords, plus the end.
+    part_offsets -- start of each polygon's rings in ring_offsets, plus the end.
+    feature_offsets -- start of each huc's polygons in part_offsets, plus the
+                       end.
+    bboxes -- (huc count, 4) xmin, ymin, xmax, ymax of each huc.
+    ids -- HUC12RNG of each huc.
+    The reference database's source hash is saved with the arrays and the
+    store is only rebuilt when it differs.
+
+    (str, str) -> bool, True if the store was (re)built
+    """
+    import os
+    import shutil
+    import sqlite3
+    import numpy as np
+    import shapely
+
+    conn = sqlite3.connect('file:{0}?mode=ro'.format(huc_db), uri=True)
+    source_hash = conn.execute("SELECT source_hash FROM reference_info;").fetchone()[0]
+    hash_file = os.path.join(store_dir, 'source_hash.txt')
+    if os.path.exists(hash_file):
+        with open(hash_file) as f:
+            if f.read().strip() == source_hash:
+                conn.close()
+                return False
+
+    # SpatiaLite BLOBs aren't WKB, so let SpatiaLite convert them
+    os.putenv('SPATIALITE_SECURITY', 'relaxed')
+    conn.enable_load_extension(True)
+    conn.execute('SELECT load_extension("mod_spatialite")')
+    rows = conn.execute("""SELECT HUC12RNG, AsBinary(geom_102008) FROM shucs
+                           WHERE geom_102008 IS NOT NULL
+                           ORDER BY ROWID;""").fetchall()
+    conn.close()
+
+    geoms = shapely.from_wkb([bytes(x[1]) for x in rows])
+    geom_type, coords, offsets = shapely.to_ragged_array(geoms)
+    if geom_type == shapely.GeometryType.POLYGON:
+        # No multipolygons, so every huc has one part
+        ring_offsets, part_offsets = offsets
+        feature_offsets = np.arange(len(geoms) + 1)
+    else:
+        ring_offsets, part_offsets, feature_offsets = offsets
+    arrays = {'coords': coords,
+              'ring_offsets': ring_offsets.astype(np.int64),
+              'part_offsets': part_offsets.astype(np.int64),
+              'feature_offsets': feature_offsets.astype(np.int64),
+              'bboxes': shapely.bounds(geoms),
+              'ids': np.array([str(x[0]) for x in rows])}
+
+    # Write next to the final directory and swap it in when it's complete
+    temp_dir = store_dir.rstrip('/') + '.building'
+    if os.path.exists(temp_dir):
+        shutil.rmtree(temp_dir)
+    os.makedirs(temp_dir)
+    for name in huc_store_arrays:
+        np.save(os.path.join(temp_dir, name + '.npy'), arrays[name])
+    with open(os.path.join(temp_dir, 'source_hash.txt'), 'w') as f:
+        f.write(source_hash)
+    if os.path.exists(store_dir):
+        shutil.rmtree(store_dir)
+    os.replace(temp_dir, store_dir)
+    return True
+
+def open_huc_store(store_dir):
+    """
+    Memory-maps the arrays written by build_huc_store read-only.  Pages are
+    shared between processes by the OS, so workers can each open the store
+    without copying it.
+
+    (str) -> dict of numpy arrays keyed by name
+    """
+    import os
+    import numpy as np
+
+    return {name: np.load(os.path.join(store_dir, name + '.npy'),
+                          mmap_mode='r')
+            for name in huc_store_arrays}
+
+def huc_store_select(store, extent):
+    """
+    Returns the indexes of the hucs in a store whose bounding boxes overlap
+    extent.
+
+    (dict, (xmin, ymin, xmax, ymax)) -> numpy array of int
+    """
+    import numpy as np
+
+    bboxes = store['bboxes']
+    xmin, ymin, xmax, ymax = extent
+    return np.nonzero((bboxes[:, 2] >= xmin) & (bboxes[:, 3] >= ymin) &
+                      (bboxes[:, 0] <= xmax) & (bboxes[:, 1] <= ymax))[0]
+
+def huc_store_geometries(store, index=None):
+    """
+    Builds shapely (multi)polygons for the hucs at 'index' (all of them if
+    None) straight from a store's arrays, copying only their coordinates.
+
+    (dict, array of int) -> (numpy array of HUC12RNG, numpy array of geometries)
+    """
+    import numpy as np
+    import shapely
+
+    def spans(offsets, which):
+        # Concatenated ranges offsets[i]:offsets[i+1] for i in which, and
+        # the new offsets that describe them.
+        starts = offsets[which]
+        lengths = offsets[which + 1] - starts
+        new_offsets = np.zeros(len(which) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=new_offsets[1:])
+        positions = (np.arange(new_offsets[-1]) -
+                     np.repeat(new_offsets[:-1] - starts, lengths))
+        return positions, new_offsets
+
+    if index is None:
+        index = np.arange(len(store['ids']))
+    index = np.asarray(index, dtype=np.int64)
+    parts, feature_offsets = spans(store['feature_offsets'], index)
+    rings, part_offsets = spans(store['part_offsets'], parts)
+    vertices, ring_offsets = spans(store['ring_offsets'], rings)
+    geoms = shapely.from_ragged_array(shapely.GeometryType.MULTIPOLYGON,
+                                      np.asarray(store['coords'][vertices]),
+                                      (ring_offsets, part_offsets,
+                                       feature_offsets))
+    return np.asarray(store['ids'][index]), geoms
+
+def coarsen_polygons(geoms, vertices):
+    """
+    Returns polygons rebuilt from 'vertices' evenly spaced vertices of each
+    polygon's exterior ring.  For circles this is the inscribed polygon with
+    fewer sides, which is plenty for concave hull inputs and much cheaper to
+    union.  Polygons that already have that few vertices are unchanged.
+
+    (array of shapely Polygons, int) -> array of shapely Polygons
+    """
+    import numpy as np
+    import shapely
+
+    geoms = np.asarray(geoms, dtype=object)
+    coords, index = shapely.get_coordinates(shapely.get_exterior_ring(geoms),
+                                            return_index=True)
+    sizes = np.bincount(index, minlength=len(geoms)) - 1  # without closing
+    starts = np.zeros(len(geoms), dtype=np.int64)
+    np.cumsum(sizes[:-1] + 1, out=starts[1:])
+    coarse = np.nonzero(sizes > vertices)[0]
+    if len(coarse) == 0:
+        return geoms
+
+    steps = np.arange(vertices)
+    keep = (starts[coarse, None] +
+            (steps[None, :] * sizes[coarse, None]) // vertices).ravel()
+    rings = shapely.linearrings(coords[keep],
+                                indices=np.repeat(np.arange(len(coarse)),
+                                                  vertices))
+    geoms = geoms.copy()
+    geoms[coarse] = shapely.polygons(rings)
+    return geoms
+
+def union_WKBs(wkbs, coarsen=None):
+    """
+    Unions geometries given as WKB (GEOS's cascaded unary union) and returns
+    the union as WKB.  Used for the partitions and merges in
+    cascaded_union.
+
+    (list of bytes, int) -> bytes
+    """
+    import shapely
+
+    geoms = shapely.from_wkb([bytes(x) for x in wkbs])
+    if coarsen:
+        geoms = coarsen_polygons(geoms, coarsen)
+    return shapely.to_wkb(shapely.union_all(geoms))
+
+def spatial_partitions(geoms, partition_size):
+    """
+    Splits geometries into groups of about partition_size that are close to
+    each other.  Bounding box centers are binned in a grid with about one
+    cell per group, cells are ordered in a serpentine so consecutive cells
+    are neighbors, and the ordered geometries are cut into groups.
+    Neighboring groups therefore overlap little with the rest, which keeps
+    the unions of groups, and the merges of consecutive groups, small.
+
+    (array of shapely geometries, int) -> list of arrays of indexes
+    """
+    import math
+    import numpy as np
+    import shapely
+
+    count = len(geoms)
+    if count <= partition_size:
+        return [np.arange(count)]
+    bounds = shapely.bounds(geoms)
+    x = (bounds[:, 0] + bounds[:, 2]) / 2
+    y = (bounds[:, 1] + bounds[:, 3]) / 2
+    cells = int(math.ceil(math.sqrt(math.ceil(count / partition_size))))
+
+    def grid_index(values):
+        span = values.max() - values.min()
+        if span == 0:
+            return np.zeros(len(values), dtype=int)
+        return np.minimum(((values - values.min()) / span * cells).astype(int),
+                          cells - 1)
+
+    column, row = grid_index(x), grid_index(y)
+    column = np.where(row % 2 == 0, column, cells - 1 - column)
+    # Within a cell, order along the serpentine's direction too
+    along = np.where(row % 2 == 0, x, -x)
+    order = np.lexsort((along, column, row))
+    return [order[i:i + partition_size]
+            for i in range(0, count, partition_size)]
+
+def cascaded_union(wkbs, workers=1, partition_size=2000, coarsen=None):
+    """
+    Unions many polygons (e.g., occurrence circles) given as WKB.  Polygons
+    are split into spatially compact partitions (spatial_partitions), each
+    partition is unioned on its own, across 'workers' processes, and the
+    partition unions are merged pairwise, neighbors first, in rounds until
+    one is left.  No single union ever has to absorb every polygon into a
+    growing intermediate result.
+
+    Returns the union as WKB, or None if there are no polygons.
+
+    (list of bytes, int, int, int) -> bytes
+
+    Arguments:
+    wkbs -- polygons as WKB.
+    workers -- number of processes.
+    partition_size -- polygons per partition.
+    coarsen -- if given, the number of vertices to keep in each polygon
+               (see coarsen_polygons); for hull inputs.
+    """
+    import shapely
+
+    wkbs = [bytes(x) for x in wkbs]
+    if not wkbs:
+        return None
+    partitions = spatial_partitions(shapely.from_wkb(wkbs), partition_size)
+    groups = [[wkbs[i] for i in partition] for partition in partitions]
+
+    def unions(pool, groups, coarsen=None):
+        args = [(x, coarsen) for x in groups]
+        if pool is None:
+            return [union_WKBs(*x) for x in args]
+        return list(pool.map(union_WKBs, *zip(*args)))
+
+    def merge(pool):
+        merged = unions(pool, groups, coarsen)
+        while len(merged) > 1:
+            merged = unions(pool, [merged[i:i + 2]
+                                   for i in range(0, len(merged), 2)])
+        return merged[0]
+
+    if workers > 1 and len(groups) > 1:
+        with process_pool(workers) as pool:
+            return merge(pool)
+    return merge(None)
@@ -0,0 +1,8 @@
+"""
+The scripts in archive_nate import each other as top level modules, so make
+the directory importable for the tests.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,56 @@
+"""
+A local stand-in for sciencebasepy.SbSession, serving GAP range zips from a
+directory, for testing download_GAP_range_CONUS2001v1 without the network.
+"""
+import os
+import shutil
+
+import repo_functions as functions
+
+
+class Offline(Exception):
+    """
+    Raised by LocalScienceBase calls while it is offline.
+    """
+
+
+class LocalScienceBase(object):
+    """
+    Serves the zips in 'source_dir' as ScienceBase items, one file per item,
+    with the item id being the zip's name without '.zip'.  Calls are counted
+    in 'calls', setting 'offline' makes every call raise Offline, and
+    'checksums' can override the md5 reported for an item.
+    """
+    def __init__(self, source_dir):
+        self.source_dir = source_dir
+        self.offline = False
+        self.checksums = {}
+        self.calls = {'find_items_by_any_text': 0, 'get_item': 0,
+                      'download_file': 0}
+
+    def called(self, name):
+        self.calls[name] += 1
+        if self.offline:
+            raise Offline('ScienceBase is not reachable')
+
+    def find_items_by_any_text(self, text):
+        self.called('find_items_by_any_text')
+        gap_id = text.split('_')[0]
+        items = [{'id': x[:-4]} for x in sorted(os.listdir(self.source_dir))
+                 if x.startswith(gap_id) and x.endswith('.zip')]
+        return {'items': items}
+
+    def get_item(self, item_id):
+        self.called('get_item')
+        name = item_id + '.zip'
+        path = os.path.join(self.source_dir, name)
+        checksum = self.checksums.get(item_id, functions.file_md5(path))
+        return {'id': item_id,
+                'files': [{'name': name, 'url': path,
+                           'checksum': {'type': 'MD5', 'value': checksum}}]}
+
+    def download_file(self, url, local_filename, destination):
+        self.called('download_file')
+        path = os.path.join(destination, local_filename)
+        shutil.copyfile(url, path)
+        return path
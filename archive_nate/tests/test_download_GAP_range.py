@@ -0,0 +1,97 @@
+"""
+Tests for the GAP range download cache in repo_functions
+(download_GAP_range_CONUS2001v1), against a local ScienceBase stand-in.
+"""
+import os
+import zipfile
+
+import pytest
+
+import repo_functions as functions
+from sciencebase_stub import LocalScienceBase, Offline
+
+gap_id = 'bybcux'
+item_id = 'bYBCUx_CONUS_Range_2001v1'
+
+
+@pytest.fixture
+def sb(tmp_path):
+    source = tmp_path / 'sciencebase'
+    source.mkdir()
+    with zipfile.ZipFile(str(source / (item_id + '.zip')), 'w') as zf:
+        zf.writestr(item_id + '.csv', 'strHUC12RNG,intGapPres\n'
+                                      '030300020101,1\n')
+        zf.writestr(item_id + '.xml', '<metadata/>')
+    return LocalScienceBase(str(source))
+
+
+@pytest.fixture
+def toDir(tmp_path):
+    path = tmp_path / 'inputs'
+    path.mkdir()
+    return str(path)
+
+
+@pytest.fixture(autouse=True)
+def no_retries(monkeypatch):
+    # Fail fast instead of backing off between retries
+    monkeypatch.setattr(functions.request_governor, 'max_retries', 0)
+
+
+def test_download_and_cache_hit(sb, toDir):
+    path = functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    assert path == os.path.join(toDir, item_id)
+    assert os.path.exists(path + '.csv') and os.path.exists(path + '.xml')
+    assert os.path.exists(os.path.join(toDir, 'bYBCUx_range_cache.json'))
+    assert sb.calls['download_file'] == 1
+
+    # The manifest's item id skips the search, and nothing is downloaded
+    again = functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    assert again == path
+    assert sb.calls == {'find_items_by_any_text': 1, 'get_item': 2,
+                        'download_file': 1}
+
+    # Unless asked to refresh
+    functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb,
+                                             refresh=True)
+    assert sb.calls['download_file'] == 2
+
+
+def test_missing_extracted_file_downloads_again(sb, toDir):
+    path = functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    os.remove(path + '.csv')
+    functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    assert sb.calls['download_file'] == 2
+    assert os.path.exists(path + '.csv')
+
+
+def test_checksum_mismatch(sb, toDir):
+    sb.checksums[item_id] = '0' * 32
+    with pytest.raises(IOError):
+        functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    # The bad download is removed and nothing is extracted or cached
+    assert os.listdir(toDir) == []
+
+
+def test_checksum_change_downloads_again(sb, toDir):
+    path = functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    with zipfile.ZipFile(os.path.join(sb.source_dir, item_id + '.zip'),
+                         'a') as zf:
+        zf.writestr('README.txt', 'updated')
+    assert functions.download_GAP_range_CONUS2001v1(gap_id, toDir,
+                                                    sb=sb) == path
+    assert sb.calls['download_file'] == 2
+    assert os.path.exists(os.path.join(toDir, 'README.txt'))
+
+
+def test_offline_fallback(sb, toDir):
+    path = functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
+    sb.offline = True
+    assert functions.download_GAP_range_CONUS2001v1(gap_id, toDir,
+                                                    sb=sb) == path
+
+
+def test_offline_without_cache(sb, toDir):
+    sb.offline = True
+    with pytest.raises(Offline):
+        functions.download_GAP_range_CONUS2001v1(gap_id, toDir, sb=sb)
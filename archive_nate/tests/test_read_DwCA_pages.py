@@ -0,0 +1,60 @@
+"""
+Tests for repo_functions.read_DwCA_pages, using a small Darwin Core Archive
+(data/dwca_occurrences.zip) with seven occurrence records.
+"""
+import os
+
+import repo_functions as functions
+
+archive = os.path.join(os.path.dirname(__file__), 'data',
+                       'dwca_occurrences.zip')
+
+
+def read_all(**kwargs):
+    return list(functions.read_DwCA_pages(archive, **kwargs))
+
+
+def test_pages_and_offsets():
+    pages = read_all(page_size=3)
+    assert [offset for offset, page in pages] == [0, 3, 6]
+    assert [len(page) for offset, page in pages] == [3, 3, 1]
+    ids = [x['gbifID'] for offset, page in pages for x in page]
+    assert ids == ['1001', '1002', '1003', '1004', '1005', '1006', '1007']
+
+
+def test_records_look_like_search_results():
+    records = dict((x['gbifID'], x) for offset, page in read_all()
+                   for x in page)
+    first = records['1001']
+    assert first['basisOfRecord'] == 'HUMAN_OBSERVATION'
+    assert first['decimalLatitude'] == 35.78
+    assert first['coordinateUncertaintyInMeters'] == 100.
+    assert first['year'] == 2015 and first['month'] == 5
+    assert first['issues'] == []
+    # Empty fields are left out
+    assert 'coordinateUncertaintyInMeters' not in records['1002']
+    assert 'month' not in records['1003']
+    # The issue column becomes the issues list
+    assert records['1003']['issues'] == ['COORDINATE_ROUNDED',
+                                         'GEODETIC_DATUM_ASSUMED_WGS84']
+    # Unparseable numbers are left out too
+    assert 'decimalLatitude' not in records['1006']
+
+
+def test_skip_resumes_at_the_same_offsets():
+    full = dict(read_all(page_size=3))
+    pages = read_all(page_size=3, skip=[0, 3])
+    assert pages == [(6, full[6])]
+    pages = read_all(page_size=3, skip=[3])
+    assert pages == [(0, full[0]), (6, full[6])]
+
+
+def test_skip_last_partial_page():
+    pages = read_all(page_size=3, skip=[6])
+    assert [offset for offset, page in pages] == [0, 3]
+
+
+def test_open_file_object():
+    with open(archive, 'rb') as f:
+        pages = list(functions.read_DwCA_pages(f, page_size=5))
+    assert [len(page) for offset, page in pages] == [5, 2]
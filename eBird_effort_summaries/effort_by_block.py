@@ -0,0 +1,69 @@
+"""
+Summarizes eBird effort by atlas block.  Input is the output from a run of
+filter_eBird_sampling.py.  This is the Python version of effort_by_block.R;
+see that script for notes on Methods A and B.  Checklist coordinates are
+reprojected as arrays and assigned to blocks with a spatial index over the
+block polygons, and checklists and minutes are tallied with grouped array
+sums.  For Method B, the blocks each footprint touches are found with
+circle-to-polygon distance tests, in parallel chunks, rather than by
+intersecting buffered footprints with the blocks.
+"""
+import os
+import time
+import effort_functions as functions
+
+if __name__ == '__main__':
+    starttime = time.time()
+
+    # Read in data and prep
+    blocks_path = os.path.expanduser("~/Data/ncba_blocks.shp")
+    filtered_checklists = os.path.expanduser("~/Documents/NCBA/Data/filtered_checklists/")
+    results_path = os.path.expanduser("~/Documents/NCBA/effort_by_block.csv")
+    # Method B leaves out checklists that traveled more than this many km, as
+    # effort_by_block.R does; None keeps them all.
+    max_distance = 5
+    workers = os.cpu_count()
+    # Block assignments of eBird locations are cached here, so geometry is only
+    # done for new locations (and footprints beyond a location's cached reach).
+    # Set to None to assign every checklist from scratch.
+    locality_cache = os.path.expanduser("~/Documents/NCBA/Data/locality_blocks.sqlite")
+    # Each checklist's contribution to block effort is kept here, so a new release
+    # only adds, removes, or redoes the checklists that changed (by checklist_id
+    # and last_edited_date).  Set to None to summarize every checklist each run.
+    effort_store = os.path.expanduser("~/Documents/NCBA/Data/effort_store.sqlite")
+    block_names, block_geoms = functions.read_blocks(blocks_path, crs=6542)
+    checklists = functions.read_filtered_checklists(filtered_checklists)
+
+    # Further filtering of sampling data could go here -----------------------------
+
+    # Methods A and B, and synthesis ------------------------------------------------
+    cache = None
+    if locality_cache is not None:
+        cache = functions.LocalityBlockCache(locality_cache, block_names,
+                                             block_geoms, crs=6542)
+
+    if effort_store is not None:
+        store = functions.EffortStore(effort_store, block_names, block_geoms,
+                                      crs=6542, max_distance=max_distance,
+                                      locality_cache=cache)
+        changes = store.update(checklists)
+        print("Checklists inserted: {inserted}, deleted: {deleted}, "
+              "edited: {edited}, unchanged: {unchanged}".format(**changes))
+        counts = store.totals()
+        store.close()
+    elif cache is not None:
+        counts = cache.effort_by_block(checklists, max_distance=max_distance)
+    else:
+        counts = functions.effort_by_block(checklists, block_names, block_geoms,
+                                           crs=6542, max_distance=max_distance,
+                                           workers=workers)
+
+    if cache is not None:
+        print("Locations from cache: {0}, assigned: {1}".format(cache.hits,
+                                                                cache.misses))
+        cache.close()
+
+    # Save results -----------------------------------------------------------------
+    counts.to_csv(results_path, index=False)
+    print("Summarized {0} checklists in {1:.1f} seconds".format(
+          len(checklists), time.time() - starttime))
@@ -0,0 +1,917 @@
+# Functions for summarizing eBird sampling data (eBird effort) for the NCBA.
+def process_pool(workers, **kwargs):
+    """
+    Returns a ProcessPoolExecutor that starts its workers the platform's
+    default way ('spawn' on macOS, where forking a process that has started
+    threads or system frameworks can crash or deadlock).  Spawned workers
+    import the main script, so scripts that use these functions keep their work under
+    "if __name__ == '__main__':".
+
+    (int, ...) -> concurrent.futures.ProcessPoolExecutor
+    """
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=workers, **kwargs)
+
+# Column types for the filtered checklists; anything else is kept as text.
+# Names are those used by auk::read_sampling.
+sampling_types = {'latitude': 'float', 'longitude': 'float',
+                  'observation_date': 'date', 'duration_minutes': 'float',
+                  'effort_distance_km': 'float', 'effort_area_ha': 'float',
+                  'number_observers': 'float', 'all_species_reported': 'int'}
+
+def sampling_column_names(header):
+    """
+    Converts the header of an eBird sampling file ('LAST EDITED DATE', ...)
+    into the column names auk::read_sampling uses ('last_edited_date', ...).
+    SAMPLING EVENT IDENTIFIER becomes checklist_id.  The empty name after the
+    file's trailing tab is dropped.
+
+    (str) -> list of str
+    """
+    names = [x.strip().lower().replace(' ', '_').replace('/', '_')
+             for x in header.rstrip('\r\n').split('\t')]
+    names = ['checklist_id' if x == 'sampling_event_identifier' else x
+             for x in names]
+    while names and names[-1] == '':
+        names.pop()
+    return names
+
+def sampling_byte_ranges(sampling_file, chunk_bytes=64 * 1024 ** 2):
+    """
+    Splits an eBird sampling file into (start, end) byte ranges of about
+    chunk_bytes, after the header.  Ranges don't need to fall on line
+    boundaries: filter_sampling_range reads each line that starts in its
+    range, so every line is read by exactly one range.
+
+    (str, int) -> list of (int, int)
+    """
+    import os
+
+    size = os.path.getsize(sampling_file)
+    with open(sampling_file, 'rb') as f:
+        start = len(f.readline())
+    return [(x, min(x + chunk_bytes, size))
+            for x in range(start, size, chunk_bytes)]
+
+def sampling_value(value, kind):
+    """
+    Converts a text value from the sampling file to a column's type; empty
+    values become None.
+    """
+    import datetime
+
+    if value == '':
+        return None
+    if kind == 'float':
+        return float(value)
+    if kind == 'int':
+        return int(value)
+    if kind == 'date':
+        return datetime.date.fromisoformat(value)
+    return value
+
+def filter_sampling_range(byte_range, sampling_file, output_dir, names,
+                          criteria, columns):
+    """
+    Reads the lines of an eBird sampling file that start within a byte range,
+    keeps checklists that meet the criteria and writes the kept columns to
+    parquet files, one per observation year, in hive-style partitions
+    (output_dir/year=2019/part-<start>.parquet).
+
+    Returns a dictionary of year: checklists written.
+
+    ((int, int), str, str, list of str, dict, list of str) -> dict
+
+    Arguments:
+    byte_range -- (start, end) from sampling_byte_ranges.
+    sampling_file -- path to the sampling file.
+    output_dir -- directory for the partitioned output.
+    names -- column names of the file, from sampling_column_names.
+    criteria -- dictionary with 'state', 'country', 'dates' (first and last
+                'YYYY-MM-DD'), and 'complete' (True for complete checklists
+                only); None or missing skips that criterion.
+    columns -- names of columns to write.
+    """
+    import os
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    start, end = byte_range
+    state_i = names.index('state_code')
+    country_i = names.index('country_code')
+    date_i = names.index('observation_date')
+    complete_i = names.index('all_species_reported')
+    column_i = [names.index(x) for x in columns]
+    state = criteria.get('state')
+    country = criteria.get('country')
+    dates = criteria.get('dates')
+    complete = criteria.get('complete')
+    # A quick test on the raw bytes skips most lines without splitting them
+    marker = (state or country or '').encode('utf-8') or None
+
+    rows = {}
+    with open(sampling_file, 'rb') as f:
+        # The line running over 'start' belongs to the previous range
+        f.seek(start - 1)
+        f.readline()
+        while f.tell() < end:
+            line = f.readline()
+            if not line:
+                break
+            if marker is not None and marker not in line:
+                continue
+            values = line.decode('utf-8').rstrip('\r\n').split('\t')
+            if state is not None and values[state_i] != state:
+                continue
+            if country is not None and values[country_i] != country:
+                continue
+            date = values[date_i]
+            if dates is not None and not dates[0] <= date <= dates[1]:
+                continue
+            if complete and values[complete_i] != '1':
+                continue
+            rows.setdefault(date[:4], []).append([values[i] for i in column_i])
+
+    # Types are set so that every part file has the same schema, even where
+    # a column is empty
+    arrow_types = {'float': pa.float64(), 'int': pa.int64(),
+                   'date': pa.date32(), None: pa.string()}
+    schema = pa.schema([(x, arrow_types[sampling_types.get(x)])
+                        for x in columns])
+    counts = {}
+    for year, year_rows in rows.items():
+        table = pa.table({name: [sampling_value(row[j],
+                                                sampling_types.get(name))
+                                 for row in year_rows]
+                          for j, name in enumerate(columns)}, schema=schema)
+        year_dir = os.path.join(output_dir, 'year={0}'.format(year))
+        os.makedirs(year_dir, exist_ok=True)
+        pq.write_table(table, os.path.join(year_dir,
+                                           'part-{0:015d}.parquet'.format(start)))
+        counts[int(year)] = len(year_rows)
+    return counts
+
+def filter_eBird_sampling(sampling_file, output_dir, state=None, country=None,
+                          dates=None, complete=True, drop=(), workers=4,
+                          chunk_bytes=64 * 1024 ** 2):
+    """
+    Filters an eBird sampling file (like auk_sampling %>% auk_filter) in
+    parallel.  The file is split into byte ranges that are filtered by
+    'workers' processes, and kept checklists are written to parquet files
+    partitioned by year in output_dir, which is replaced.  Read them with
+    read_filtered_checklists.
+
+    Returns a dictionary of year: checklists kept.
+
+    (str, str, str, str, (str, str), bool, list, int, int) -> dict
+
+    Arguments:
+    sampling_file -- path to the tab-delimited sampling file.
+    output_dir -- directory for the output.
+    state -- state code to keep, e.g. 'US-NC'.
+    country -- country code to keep, e.g. 'US'.
+    dates -- first and last observation dates to keep, as 'YYYY-MM-DD'.
+    complete -- True to keep only complete checklists.
+    drop -- column names (as in sampling_column_names) to leave out.
+    workers -- number of processes.
+    chunk_bytes -- size of the byte ranges.
+    """
+    import functools
+    import os
+    import shutil
+
+    with open(sampling_file, encoding='utf-8') as f:
+        names = sampling_column_names(f.readline())
+    columns = [x for x in names if x not in drop]
+    criteria = {'state': state, 'country': country, 'dates': dates,
+                'complete': complete}
+
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    os.makedirs(output_dir)
+
+    ranges = sampling_byte_ranges(sampling_file, chunk_bytes)
+    task = functools.partial(filter_sampling_range,
+                             sampling_file=sampling_file,
+                             output_dir=output_dir, names=names,
+                             criteria=criteria, columns=columns)
+    counts = {}
+    if workers > 1:
+        with process_pool(workers) as pool:
+            range_counts = list(pool.map(task, ranges))
+    else:
+        range_counts = [task(x) for x in ranges]
+    for range_count in range_counts:
+        for year, count in range_count.items():
+            counts[year] = counts.get(year, 0) + count
+    return counts
+
+def read_filtered_checklists(output_dir, years=None, columns=None,
+                             unique=True):
+    """
+    Reads checklists written by filter_eBird_sampling into a data frame,
+    optionally only some years (partitions) and columns.  Rows are sorted by
+    checklist_id so results don't depend on how the file was split.
+
+    Like auk::read_sampling, shared (group) checklists are collapsed to one
+    unless unique is False: the one with the lowest checklist_id is kept and
+    its checklist_id becomes the group_identifier.
+
+    (str, list of int, list of str, bool) -> pandas DataFrame
+    """
+    import pyarrow.dataset as ds
+
+    dataset = ds.dataset(output_dir, format='parquet', partitioning='hive')
+    year_filter = None
+    if years is not None:
+        year_filter = ds.field('year').isin(list(years))
+    read_columns = columns
+    if columns is not None:
+        read_columns = list(columns)
+        for x in ('checklist_id', 'group_identifier'):
+            if x not in read_columns and (x == 'checklist_id' or unique):
+                read_columns.append(x)
+    checklists = dataset.to_table(columns=read_columns,
+                                  filter=year_filter).to_pandas()
+    checklists = checklists.sort_values('checklist_id').reset_index(drop=True)
+
+    if unique:
+        group = checklists['group_identifier']
+        checklists = checklists[group.isna() | ~group.duplicated()].copy()
+        grouped = checklists['group_identifier'].notna()
+        checklists.loc[grouped, 'checklist_id'] = \
+            checklists.loc[grouped, 'group_identifier']
+        checklists = checklists.reset_index(drop=True)
+        if columns is not None and 'group_identifier' not in columns:
+            checklists = checklists.drop(columns='group_identifier')
+    return checklists
+
+def read_blocks(blocks_path, crs=6542):
+    """
+    Reads the atlas blocks shapefile and reprojects it.
+
+    (str, int) -> (numpy array of block names, numpy array of shapely
+                   polygons)
+    """
+    import geopandas
+
+    blocks = geopandas.read_file(blocks_path).to_crs(crs)
+    return blocks['name'].to_numpy(), blocks.geometry.to_numpy()
+
+def project_coordinates(longitudes, latitudes, crs=6542):
+    """
+    Reprojects arrays of WGS84 coordinates in one call.
+
+    (array, array, int) -> (numpy array of x, numpy array of y)
+    """
+    import numpy as np
+    from pyproj import Transformer
+
+    transformer = Transformer.from_crs(4326, crs, always_xy=True)
+    return transformer.transform(np.asarray(longitudes, dtype=float),
+                                 np.asarray(latitudes, dtype=float))
+
+def assign_blocks_A(x, y, blocks):
+    """
+    Method A: finds the block each checklist coordinate is within, with the
+    blocks' STRtree.  Coordinates outside every block (or on a boundary)
+    aren't assigned.
+
+    Returns parallel arrays of checklist and block indexes.
+
+    (array, array, shapely STRtree) -> (numpy array, numpy array)
+    """
+    import shapely
+
+    checklist_i, block_i = blocks.query(shapely.points(x, y),
+                                        predicate='within')
+    return checklist_i, block_i
+
+def block_totals(block_i, minutes, block_count):
+    """
+    Counts checklists and sums minutes per block from an assignment of
+    checklists to blocks.  Missing durations count as 0 minutes.
+
+    (array of block indexes, array of minutes per assignment, int) ->
+        (numpy array of checklists, numpy array of minutes)
+    """
+    import numpy as np
+
+    minutes = np.nan_to_num(np.asarray(minutes, dtype=float))
+    return (np.bincount(block_i, minlength=block_count),
+            np.bincount(block_i, weights=minutes, minlength=block_count))
+
+def footprint_radii(distances):
+    """
+    Method B footprint radii in meters: the effort distance plus 100 m, with
+    missing distances as 0.
+
+    (array of km) -> numpy array of meters
+    """
+    import numpy as np
+
+    return (np.nan_to_num(np.asarray(distances, dtype=float)) + 0.1) * 1000
+
+def assign_blocks_B(x, y, radii, blocks):
+    """
+    Method B: finds the blocks each checklist's circular footprint (centered
+    on the coordinate, with the given radius) touches, with the blocks'
+    STRtree.  A circle touches a block when the block is within a radius of
+    the center (distance 0 if the center is in the block), so no buffer or
+    intersection geometry is made.
+
+    Returns parallel arrays of checklist and block indexes.
+
+    (array, array, array of meters, shapely STRtree) ->
+        (numpy array, numpy array)
+    """
+    import shapely
+
+    checklist_i, block_i = blocks.query(shapely.points(x, y),
+                                        predicate='dwithin', distance=radii)
+    return checklist_i, block_i
+
+# Block polygons and their STRtree, loaded once per process by
+# load_block_tree.
+block_tree_cache = {}
+
+def load_block_tree(block_geoms):
+    """
+    Builds an STRtree over the block polygons and keeps it in
+    block_tree_cache for method_B_chunk.  Used as the initializer of the
+    worker processes in method_B_totals.
+
+    (array of shapely polygons) -> None
+    """
+    from shapely.strtree import STRtree
+
+    block_tree_cache['count'] = len(block_geoms)
+    block_tree_cache['tree'] = STRtree(block_geoms)
+
+def method_B_chunk(x, y, radii, minutes):
+    """
+    Method B checklists and minutes per block for a chunk of checklists,
+    with the STRtree from load_block_tree.
+
+    (array, array, array, array) ->
+        (numpy array of checklists, numpy array of minutes)
+    """
+    checklist_i, block_i = assign_blocks_B(x, y, radii,
+                                           block_tree_cache['tree'])
+    return block_totals(block_i, minutes[checklist_i],
+                        block_tree_cache['count'])
+
+def method_B_totals(x, y, distances, minutes, block_geoms, max_distance=None,
+                    workers=1, chunk_size=50000):
+    """
+    Method B checklists and minutes per block.  Checklists are split into
+    chunks that are processed in parallel across 'workers' processes, each
+    holding its own STRtree of the blocks, and the chunks' totals are added.
+
+    (array, array, array of km, array of minutes, array of polygons, float,
+     int, int) -> (numpy array of checklists, numpy array of minutes)
+
+    Arguments:
+    x, y -- checklist coordinates in the blocks' CRS (meters).
+    distances -- effort distances in km.
+    minutes -- checklist durations.
+    block_geoms -- block polygons.
+    max_distance -- if given, checklists that traveled more km than this are
+                    left out.
+    workers -- number of processes.
+    chunk_size -- checklists per chunk.
+    """
+    import numpy as np
+
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    minutes = np.asarray(minutes, dtype=float)
+    radii = footprint_radii(distances)
+    if max_distance is not None:
+        keep = radii <= (max_distance + 0.1) * 1000
+        x, y, radii, minutes = x[keep], y[keep], radii[keep], minutes[keep]
+
+    chunks = [(x[i:i + chunk_size], y[i:i + chunk_size],
+               radii[i:i + chunk_size], minutes[i:i + chunk_size])
+              for i in range(0, len(x), chunk_size)]
+    checklists_B = np.zeros(len(block_geoms), dtype=np.int64)
+    minutes_B = np.zeros(len(block_geoms))
+    if workers > 1 and len(chunks) > 1:
+        with process_pool(workers, initializer=load_block_tree,
+                          initargs=(block_geoms,)) as pool:
+            totals = list(pool.map(method_B_chunk, *zip(*chunks)))
+    else:
+        load_block_tree(block_geoms)
+        totals = [method_B_chunk(*chunk) for chunk in chunks]
+    for chunk_checklists, chunk_minutes in totals:
+        checklists_B += chunk_checklists
+        minutes_B += chunk_minutes
+    return checklists_B, minutes_B
+
+def synthesize_methods(block_names, checklists_A, minutes_A, checklists_B,
+                       minutes_B):
+    """
+    Joins Method A and B totals per block, with the uncertainty (B - A) of
+    each, as in the synthesis in effort_by_block.R.
+
+    Returns a data frame with name, checklists_A, checklists_B,
+    list_uncertainty, minutes_A, minutes_B and minutes_uncertainty, sorted by
+    name.
+    """
+    import pandas as pd
+
+    counts = pd.DataFrame({'name': block_names,
+                           'checklists_A': checklists_A,
+                           'checklists_B': checklists_B,
+                           'list_uncertainty': checklists_B - checklists_A,
+                           'minutes_A': minutes_A,
+                           'minutes_B': minutes_B,
+                           'minutes_uncertainty': minutes_B - minutes_A})
+    return counts.sort_values('name').reset_index(drop=True)
+
+def effort_by_block(checklists, block_names, block_geoms, crs=6542,
+                    max_distance=None, workers=1, chunk_size=50000):
+    """
+    Summarizes checklists and minutes of effort per atlas block with
+    Method A (the block the checklist's coordinate is in) and Method B (the
+    blocks the checklist's footprint, a circle of the effort distance plus
+    100 m, touches); see effort_by_block.R.  Every block is included, with
+    zeros where there wasn't any effort.
+
+    (pandas DataFrame, array, array, int, float, int, int) -> pandas DataFrame
+    from synthesize_methods
+
+    Arguments:
+    checklists -- data frame from read_filtered_checklists.
+    block_names -- names of the blocks.
+    block_geoms -- block polygons in crs.
+    crs -- EPSG code of a projected CRS, in meters.
+    max_distance -- effort distance (km) above which checklists are left out
+                    of Method B; None keeps them all.  effort_by_block.R
+                    used 5.
+    workers -- number of processes for Method B.
+    chunk_size -- checklists per Method B chunk.
+    """
+    from shapely.strtree import STRtree
+
+    x, y = project_coordinates(checklists['longitude'],
+                               checklists['latitude'], crs)
+    minutes = checklists['duration_minutes'].to_numpy(dtype=float)
+
+    checklist_i, block_i = assign_blocks_A(x, y, STRtree(block_geoms))
+    checklists_A, minutes_A = block_totals(block_i, minutes[checklist_i],
+                                           len(block_names))
+    checklists_B, minutes_B = method_B_totals(
+                                x, y,
+                                checklists['effort_distance_km'].to_numpy(dtype=float),
+                                minutes, block_geoms, max_distance, workers,
+                                chunk_size)
+    return synthesize_methods(block_names, checklists_A, minutes_A,
+                              checklists_B, minutes_B)
+
+def blocks_hash(block_names, block_geoms):
+    """
+    sha1 hex digest of block names and polygons (as WKB), used to tell
+    whether a cache or store was built with the same blocks.
+
+    (array, array of shapely polygons) -> str
+    """
+    import hashlib
+    import shapely
+
+    digest = hashlib.sha1()
+    for name, wkb in zip(block_names, shapely.to_wkb(block_geoms)):
+        digest.update(str(name).encode('utf-8'))
+        digest.update(wkb)
+    return digest.hexdigest()
+
+class LocalityBlockCache(object):
+    """
+    Persistent (sqlite) cache of block assignments of eBird locations, so
+    block geometry is done once per location rather than once per
+    checklist.  Locations are keyed by locality_id and coordinates (a
+    locality that's moved is a new location).  For Method A the cache holds
+    the block each location is in.  For Method B it holds the blocks within
+    a reach of the location and their distances from it, so the blocks a
+    footprint touches are those no farther than its exact radius.  A
+    location's blocks are found again, farther out, only when a footprint
+    is larger than the reach they were cached to.
+
+    The cache is cleared when the blocks (names, polygons, CRS) differ from
+    those it was built with.
+
+    Arguments:
+    path -- path of the cache database.
+    block_names -- names of the blocks.
+    block_geoms -- block polygons in crs.
+    crs -- EPSG code of the blocks' CRS, in meters.
+    reach -- shortest distance (meters) to cache blocks to around a
+             location.  5100 covers the footprints of checklists up to the
+             5 km max_distance used by effort_by_block.R.
+    """
+    def __init__(self, path, block_names, block_geoms, crs=6542, reach=5100):
+        import sqlite3
+        import numpy as np
+        from shapely.strtree import STRtree
+
+        self.block_names = block_names
+        self.block_geoms = np.asarray(block_geoms)
+        self.crs = crs
+        self.reach = reach
+        self.blocks = STRtree(self.block_geoms)
+        self.hits = 0
+        self.misses = 0
+
+        info = (blocks_hash(block_names, block_geoms), crs)
+
+        self.conn = sqlite3.connect(path)
+        try:
+            built = self.conn.execute("SELECT * FROM cache_info;").fetchone()
+        except sqlite3.OperationalError:
+            built = None
+        if built != info:
+            # Also drops the radius bucket tables of older caches
+            self.conn.executescript("""
+                DROP TABLE IF EXISTS cache_info;
+                DROP TABLE IF EXISTS blocks_A;
+                DROP TABLE IF EXISTS blocks_B;
+                DROP TABLE IF EXISTS block_distances;
+
+                CREATE TABLE cache_info (blocks_hash TEXT, crs INTEGER);
+
+                CREATE TABLE blocks_A (
+                    locality_id TEXT, latitude REAL, longitude REAL,
+                    block INTEGER,
+                    PRIMARY KEY (locality_id, latitude, longitude));
+
+                CREATE TABLE block_distances (
+                    locality_id TEXT, latitude REAL, longitude REAL,
+                    reach REAL, blocks TEXT, distances TEXT,
+                    PRIMARY KEY (locality_id, latitude, longitude));
+                """)
+            self.conn.execute("INSERT INTO cache_info VALUES (?, ?);", info)
+            self.conn.commit()
+
+    def cached(self, table, columns, keys):
+        """
+        Cached rows of a table for a set of location keys, (locality_id,
+        latitude, longitude), as a dictionary of key: tuple of columns.  Rows
+        are selected by locality_id, 500 at a time, rather than reading the
+        whole table.
+        """
+        keys = set(keys)
+        ids = sorted(set(x[0] for x in keys))
+        rows = {}
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            for row in self.conn.execute(
+                    """SELECT locality_id, latitude, longitude, {0}
+                       FROM {1}
+                       WHERE locality_id IN ({2});""".format(
+                    ', '.join(columns), table, ','.join('?' * len(chunk))),
+                    chunk):
+                if row[:3] in keys:
+                    rows[row[:3]] = row[3:]
+        return rows
+
+    def blocks_A(self, localities):
+        """
+        Method A block index of each location, or -1 if it isn't in a block.
+
+        (pandas DataFrame with locality_id, latitude and longitude) ->
+            numpy array
+        """
+        import numpy as np
+
+        keys = list(zip(localities['locality_id'], localities['latitude'],
+                        localities['longitude']))
+        cached = self.cached('blocks_A', ['block'], keys)
+        block_i = np.array([cached[x][0] if x in cached else -2 for x in keys],
+                           dtype=np.int64)
+
+        missing = np.nonzero(block_i == -2)[0]
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            x, y = project_coordinates(localities['longitude'].to_numpy()[missing],
+                                       localities['latitude'].to_numpy()[missing],
+                                       self.crs)
+            block_i[missing] = -1
+            location_i, within_i = assign_blocks_A(x, y, self.blocks)
+            block_i[missing[location_i]] = within_i
+            self.conn.executemany("INSERT OR REPLACE INTO blocks_A VALUES (?, ?, ?, ?);",
+                                  [keys[i] + (int(block_i[i]),) for i in missing])
+            self.conn.commit()
+        return block_i
+
+    def blocks_B(self, localities, radii):
+        """
+        Method B blocks touched by footprints of the given radii (meters)
+        around locations: the blocks no farther from the location than the
+        radius, as assign_blocks_B finds.
+
+        Returns parallel arrays of location (row) and block indexes.
+
+        (pandas DataFrame with locality_id, latitude and longitude, array) ->
+            (numpy array, numpy array)
+        """
+        import json
+        import numpy as np
+        import shapely
+
+        keys = list(zip(localities['locality_id'], localities['latitude'],
+                        localities['longitude']))
+        radii = np.asarray(radii, dtype=float)
+
+        # The reach each location's blocks are needed to
+        reach = {}
+        for key, radius in zip(keys, radii):
+            reach[key] = max(reach.get(key, self.reach), radius)
+        cached = self.cached('block_distances',
+                             ['reach', 'blocks', 'distances'], reach)
+        neighbors = {}
+        for key, (cached_reach, blocks, distances) in cached.items():
+            if cached_reach >= reach[key]:
+                neighbors[key] = (np.array(json.loads(blocks), dtype=np.int64),
+                                  np.array(json.loads(distances)))
+
+        missing = [x for x in reach if x not in neighbors]
+        self.hits += len(reach) - len(missing)
+        self.misses += len(missing)
+        if missing:
+            x, y = project_coordinates([x[2] for x in missing],
+                                       [x[1] for x in missing], self.crs)
+            points = shapely.points(x, y)
+            location_i, block_i = self.blocks.query(
+                                    points, predicate='dwithin',
+                                    distance=np.array([reach[x] for x in missing]))
+            distances = shapely.distance(points[location_i],
+                                         self.block_geoms[block_i])
+            rows = []
+            for i, key in enumerate(missing):
+                found = location_i == i
+                neighbors[key] = (block_i[found], distances[found])
+                rows.append(key + (float(reach[key]),
+                                   json.dumps(block_i[found].tolist()),
+                                   json.dumps(distances[found].tolist())))
+            self.conn.executemany("""INSERT OR REPLACE INTO block_distances
+                                     VALUES (?, ?, ?, ?, ?, ?);""", rows)
+            self.conn.commit()
+
+        location_i, block_i = [], []
+        for i, (key, radius) in enumerate(zip(keys, radii)):
+            blocks, distances = neighbors[key]
+            touched = blocks[distances <= radius]
+            location_i.append(np.full(len(touched), i, dtype=np.int64))
+            block_i.append(touched)
+        if not location_i:
+            return np.array([], dtype=np.int64), np.array([], dtype=np.int64)
+        return np.concatenate(location_i), np.concatenate(block_i)
+
+    def effort_by_block(self, checklists, max_distance=None):
+        """
+        effort_by_block with block assignments from the cache.  Checklists
+        are grouped by location (and footprint radius for Method B), so each
+        checklist is only a join against the cache.
+
+        (pandas DataFrame, float) -> pandas DataFrame from synthesize_methods
+        """
+        import numpy as np
+
+        block_count = len(self.block_names)
+        checklists = checklists.assign(
+            duration_minutes=checklists['duration_minutes'].fillna(0),
+            radius=footprint_radii(checklists['effort_distance_km']))
+        location = ['locality_id', 'latitude', 'longitude']
+
+        # Method A, by location
+        by_location = (checklists.groupby(location, sort=False)
+                       .agg(checklists=('checklist_id', 'size'),
+                            minutes=('duration_minutes', 'sum'))
+                       .reset_index())
+        block_i = self.blocks_A(by_location)
+        inside = block_i >= 0
+        checklists_A = np.bincount(block_i[inside],
+                                   weights=by_location['checklists'].to_numpy()[inside],
+                                   minlength=block_count).astype(np.int64)
+        minutes_A = np.bincount(block_i[inside],
+                                weights=by_location['minutes'].to_numpy()[inside],
+                                minlength=block_count)
+
+        # Method B, by location and radius
+        if max_distance is not None:
+            checklists = checklists[checklists['radius'] <=
+                                    (max_distance + 0.1) * 1000]
+        by_radius = (checklists.groupby(location + ['radius'], sort=False)
+                     .agg(checklists=('checklist_id', 'size'),
+                          minutes=('duration_minutes', 'sum'))
+                     .reset_index())
+        location_i, block_i = self.blocks_B(by_radius, by_radius['radius'])
+        checklists_B = np.bincount(block_i,
+                                   weights=by_radius['checklists'].to_numpy()[location_i],
+                                   minlength=block_count).astype(np.int64)
+        minutes_B = np.bincount(block_i,
+                                weights=by_radius['minutes'].to_numpy()[location_i],
+                                minlength=block_count)
+        return synthesize_methods(self.block_names, checklists_A, minutes_A,
+                                  checklists_B, minutes_B)
+
+    def close(self):
+        self.conn.close()
+
+class EffortStore(object):
+    """
+    Persistent (sqlite) store of each checklist's contribution to block
+    effort, with running block totals, so a new eBird release only costs
+    the checklists that changed.  update() compares the release's
+    checklist_id and last_edited_date with the store's: checklists that are
+    new are added to the totals, checklists that are gone are subtracted,
+    and edited checklists are subtracted and added again.
+
+    The store is emptied when the blocks, CRS or max_distance differ from
+    those it was built with, so the next update() starts over.
+
+    Arguments:
+    path -- path of the store database.
+    block_names -- names of the blocks.
+    block_geoms -- block polygons in crs.
+    crs -- EPSG code of the blocks' CRS, in meters.
+    max_distance -- effort distance (km) above which checklists are left out
+                    of Method B; None keeps them all.
+    locality_cache -- a LocalityBlockCache for the same blocks to assign
+                      checklists with; None to assign them directly.
+    """
+    def __init__(self, path, block_names, block_geoms, crs=6542,
+                 max_distance=None, locality_cache=None):
+        import sqlite3
+        from shapely.strtree import STRtree
+
+        self.block_names = block_names
+        self.crs = crs
+        self.max_distance = max_distance
+        self.locality_cache = locality_cache
+        self.blocks = STRtree(block_geoms)
+
+        info = (blocks_hash(block_names, block_geoms), crs, max_distance)
+
+        self.conn = sqlite3.connect(path)
+        try:
+            built = self.conn.execute("SELECT * FROM store_info;").fetchone()
+        except sqlite3.OperationalError:
+            built = None
+        if built != info:
+            # Also drops the store_info of older stores, which had a radius
+            # bucket column
+            self.conn.execute("DROP TABLE IF EXISTS store_info;")
+        self.conn.executescript("""
+            CREATE TABLE IF NOT EXISTS store_info (blocks_hash TEXT,
+                                                   crs INTEGER,
+                                                   max_distance REAL);
+
+            CREATE TABLE IF NOT EXISTS checklists (
+                checklist_id TEXT PRIMARY KEY, last_edited_date TEXT,
+                minutes REAL, block_A INTEGER, blocks_B TEXT);
+
+            CREATE TABLE IF NOT EXISTS block_totals (
+                block INTEGER PRIMARY KEY, name TEXT,
+                checklists_A INTEGER, minutes_A REAL,
+                checklists_B INTEGER, minutes_B REAL);
+            """)
+        if built != info:
+            self.conn.executescript("""DELETE FROM checklists;
+                                       DELETE FROM block_totals;""")
+            self.conn.execute("INSERT INTO store_info VALUES (?, ?, ?);", info)
+            self.conn.executemany("""INSERT INTO block_totals
+                                     VALUES (?, ?, 0, 0, 0, 0);""",
+                                  [(i, str(x)) for i, x in enumerate(block_names)])
+            self.conn.commit()
+
+    def contributions(self, checklists):
+        """
+        The Method A block (-1 for none) and Method B blocks of each
+        checklist.
+
+        (pandas DataFrame) -> (numpy array, list of lists)
+        """
+        import numpy as np
+
+        radii = footprint_radii(checklists['effort_distance_km'])
+        in_B = np.ones(len(checklists), dtype=bool)
+        if self.max_distance is not None:
+            in_B = radii <= (self.max_distance + 0.1) * 1000
+        B_rows = np.nonzero(in_B)[0]
+
+        if self.locality_cache is not None:
+            block_A = self.locality_cache.blocks_A(checklists)
+            row_i, block_i = self.locality_cache.blocks_B(
+                                checklists.iloc[B_rows], radii[B_rows])
+        else:
+            x, y = project_coordinates(checklists['longitude'],
+                                       checklists['latitude'], self.crs)
+            block_A = np.full(len(checklists), -1, dtype=np.int64)
+            row_i, within_i = assign_blocks_A(x, y, self.blocks)
+            block_A[row_i] = within_i
+            row_i, block_i = assign_blocks_B(x[B_rows], y[B_rows],
+                                             radii[B_rows], self.blocks)
+
+        blocks_B = [[] for x in range(len(checklists))]
+        for i, b in zip(B_rows[row_i], block_i):
+            blocks_B[i].append(int(b))
+        return block_A, blocks_B
+
+    def update(self, checklists):
+        """
+        Brings the store up to date with a release's checklists (a data frame
+        from read_filtered_checklists).
+
+        Returns a dictionary with the number of checklists inserted, deleted,
+        edited and unchanged.
+        """
+        import json
+        import numpy as np
+
+        block_count = len(self.block_names)
+        stored = dict(self.conn.execute("""SELECT checklist_id, last_edited_date
+                                           FROM checklists;"""))
+        edited_dates = [None if x != x or x is None else str(x)
+                        for x in checklists['last_edited_date']]
+        release = dict(zip(checklists['checklist_id'], edited_dates))
+
+        deleted = [x for x in stored if x not in release]
+        edited = [x for x in stored if x in release and stored[x] != release[x]]
+        changed = np.array([x not in stored or stored[x] != release[x]
+                            for x in checklists['checklist_id']], dtype=bool)
+        counts = {'inserted': int(changed.sum()) - len(edited),
+                  'deleted': len(deleted), 'edited': len(edited),
+                  'unchanged': len(checklists) - int(changed.sum())}
+
+        # Changes to the totals, by block: checklists A, minutes A,
+        # checklists B, minutes B
+        delta = np.zeros((block_count, 4))
+
+        # Take out the old versions of deleted and edited checklists
+        removed = deleted + edited
+        for i in range(0, len(removed), 500):
+            ids = removed[i:i + 500]
+            rows = self.conn.execute("""SELECT minutes, block_A, blocks_B
+                                        FROM checklists
+                                        WHERE checklist_id IN ({0});""".format(
+                                     ','.join('?' * len(ids))), ids).fetchall()
+            for minutes, block_A, blocks_B in rows:
+                if block_A >= 0:
+                    delta[block_A, 0] -= 1
+                    delta[block_A, 1] -= minutes
+                for block in json.loads(blocks_B):
+                    delta[block, 2] -= 1
+                    delta[block, 3] -= minutes
+
+        # Add new and edited checklists
+        new = checklists[changed].reset_index(drop=True)
+        minutes = np.nan_to_num(new['duration_minutes'].to_numpy(dtype=float))
+        block_A, blocks_B = self.contributions(new) if len(new) else ([], [])
+        for minute, block, blocks in zip(minutes, block_A, blocks_B):
+            if block >= 0:
+                delta[block, 0] += 1
+                delta[block, 1] += minute
+            for b in blocks:
+                delta[b, 2] += 1
+                delta[b, 3] += minute
+
+        with self.conn:
+            self.conn.executemany("DELETE FROM checklists WHERE checklist_id = ?;",
+                                  [(x,) for x in removed])
+            self.conn.executemany("INSERT INTO checklists VALUES (?, ?, ?, ?, ?);",
+                                  [(checklist_id, release[checklist_id],
+                                    float(minute), int(block), json.dumps(blocks))
+                                   for checklist_id, minute, block, blocks
+                                   in zip(new['checklist_id'], minutes,
+                                          block_A, blocks_B)])
+            self.conn.executemany("""UPDATE block_totals
+                                     SET checklists_A = checklists_A + ?,
+                                         minutes_A = minutes_A + ?,
+                                         checklists_B = checklists_B + ?,
+                                         minutes_B = minutes_B + ?
+                                     WHERE block = ?;""",
+                                  [(int(d[0]), float(d[1]), int(d[2]),
+                                    float(d[3]), i)
+                                   for i, d in enumerate(delta) if d.any()])
+        return counts
+
+    def totals(self):
+        """
+        Current block totals, as a data frame from synthesize_methods.
+        """
+        import numpy as np
+
+        rows = np.array(self.conn.execute("""SELECT checklists_A, minutes_A,
+                                                    checklists_B, minutes_B
+                                             FROM block_totals
+                                             ORDER BY block;""").fetchall(),
+                        dtype=float).reshape(-1, 4)
+        return synthesize_methods(self.block_names,
+                                  rows[:, 0].astype(np.int64), rows[:, 1],
+                                  rows[:, 2].astype(np.int64), rows[:, 3])
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,41 @@
+"""
+The eBird sampling dataset can be downloaded from eBird, but includes many
+records that are not relevant for the NCBA.  Therefore, checklist records of
+interest must be extracted.  This does the same filtering as
+filter_eBird_sampling.R (auk), but splits the file into byte ranges that are
+filtered in parallel, and saves the checklists as parquet files partitioned
+by year that can be read by other scripts with
+effort_functions.read_filtered_checklists.
+"""
+import os
+import time
+import effort_functions as functions
+
+if __name__ == '__main__':
+    # Set a path for the output
+    output_dir = os.path.expanduser("~/Documents/NCBA/Data/filtered_checklists/")
+
+    # Path to sampling data set
+    sampling_file = "/Volumes/eBird/ebd_sampling_relFeb-2021/ebd_sampling_relFeb-2021.txt"
+    print(sampling_file)
+
+    # Filtering criteria
+    state = "US-NC"
+    country = "US"
+    dates = ("2016-01-01", "2021-12-31")
+    workers = os.cpu_count()
+
+    # Filter the sampling data and save results to the output directory. Note that
+    # only complete checklists are kept.
+    starttime = time.time()
+    counts = functions.filter_eBird_sampling(sampling_file, output_dir,
+                                             state=state, country=country,
+                                             dates=dates, complete=True,
+                                             drop=("country", "country_code",
+                                                   "state", "state_code"),
+                                             workers=workers)
+    print("Filtered in {0:.1f} minutes".format((time.time() - starttime) / 60))
+    for year in sorted(counts):
+        print("{0}: {1} checklists".format(year, counts[year]))
+
+    # Now explore the filtered checklist records in another script.